@@ -0,0 +1,436 @@
+# Incremental aggregation of detection results for the dashboard
+#
+# server.js recomputes /api/dashboard-stats, /api/damage-distribution and
+# /api/severity-breakdown with full collection scans on every request. The
+# StreamingAggregator keeps running rollups instead: every run_detection result
+# updates the counters once, and the dashboard queries read them in constant time.
+# detect.py --serve keeps the aggregator in memory; one-shot detect.py runs update
+# the snapshot file directly (update_snapshot).
+#
+# Rollups kept:
+#   - severity.level counts
+#   - detection counts per YOLO class and image counts per ViT damage type
+#   - area_score sum / max and processing time sum
+#   - daily buckets (inspections and severe count per day)
+#   - geo buckets on a GEO_CELL_DEG grid (count, severe count, area score)
+#
+# Usage:
+#   python models/aggregator.py rebuild <results.json | results.jsonl | raw_dir>... [--snapshot path]
+#   python models/aggregator.py query <dashboard-stats | damage-distribution | severity-breakdown | hotspots> [--snapshot path]
+
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+
+from detections import DetectionArray
+
+# Default snapshot location - can be overridden with the DETECT_AGGREGATE_SNAPSHOT environment variable
+DEFAULT_SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aggregate_snapshot.json")
+# Size of a geo bucket in degrees (0.01 deg is roughly 1.1 km of latitude)
+GEO_CELL_DEG = 0.01
+# Number of hotspots kept ranked for the hotspots query
+HOTSPOT_LIMIT = 20
+# Severity levels in increasing order, as returned by get_severity
+SEVERITY_LEVELS = ["low", "moderate", "high", "severe"]
+
+# Chart names used by /api/damage-distribution for each ViT damage type
+DAMAGE_TYPE_NAMES = {
+    "pothole": "Potholes",
+    "alligator_crack": "Alligator Cracks",
+    "lateral_crack": "Lateral Cracks",
+    "longitudinal_crack": "Longitudinal Cracks",
+    "edge_crack": "Edge Cracks",
+    "rutting": "Rutting",
+    "raveling": "Raveling"
+}
+
+def geo_cell(latitude, longitude):
+    """Grid cell key ("lat,lon" cell indices on the GEO_CELL_DEG grid) for a location."""
+    # Round before flooring: 1.0 / 0.01 is 99.99999999999999 in floating point,
+    # which would put a point on a cell edge into the cell below
+    return f"{math.floor(round(latitude / GEO_CELL_DEG, 9))},{math.floor(round(longitude / GEO_CELL_DEG, 9))}"
+
+class StreamingAggregator:
+    """
+    Running rollups over detection results.
+
+    update() is O(detections in the result + HOTSPOT_LIMIT); every query is
+    independent of the number of results aggregated so far.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.severity_counts = {level: 0 for level in SEVERITY_LEVELS}
+        self.class_counts = defaultdict(int)        # YOLO detections per class
+        self.damage_type_counts = defaultdict(int)  # images per ViT prediction
+        self.no_damage_type = 0                     # images without any ViT prediction
+        self.area_score_sum = 0.0
+        self.area_score_max = 0.0
+        self.processing_time_sum = 0.0
+        self.processing_time_count = 0
+        self.daily = defaultdict(lambda: {"count": 0, "severe": 0})
+        self.geo = defaultdict(lambda: {"count": 0, "severe": 0, "area_score": 0.0, "lat_sum": 0.0, "lon_sum": 0.0})
+        self.hotspots = []  # Geo cell keys ranked by count, at most HOTSPOT_LIMIT
+        self.last_update = None
+
+    def update(self, result, timestamp=None):
+        """
+        Add one run_detection result to the rollups.
+
+        Args:
+            result (dict): Result in the run_detection schema, with detections as a list of
+                dicts or a DetectionArray (results with an "error" key are ignored)
+            timestamp (datetime, optional): When the image was analysed, defaults to
+                result["timestamp"] if present, otherwise now
+        """
+        if "error" in result:
+            return
+        if timestamp is None:
+            timestamp = datetime.fromisoformat(result["timestamp"]) if result.get("timestamp") else datetime.now()
+
+        level = result["severity"]["level"].lower()
+        severe = level in ("high", "severe")
+
+        self.total += 1
+        self.severity_counts[level] = self.severity_counts.get(level, 0) + 1
+        detections = result["detections"]
+        if isinstance(detections, DetectionArray):
+            # Count classes on the column instead of walking per-box dicts
+            counts = np.bincount(detections.cls, minlength=len(detections.class_names))
+            for cls_name, count in zip(detections.class_names, counts.tolist()):
+                if count:
+                    self.class_counts[cls_name] += count
+        else:
+            for detection in detections:
+                self.class_counts[detection["class"]] += 1
+        if result.get("vit_predictions"):
+            for damage_type in result["vit_predictions"]:
+                self.damage_type_counts[damage_type] += 1
+        else:
+            self.no_damage_type += 1
+
+        area_score = result["severity"]["area_score"]
+        self.area_score_sum += area_score
+        self.area_score_max = max(self.area_score_max, area_score)
+        if result.get("processing_time") is not None:
+            self.processing_time_sum += result["processing_time"]
+            self.processing_time_count += 1
+
+        day = self.daily[timestamp.date().isoformat()]
+        day["count"] += 1
+        day["severe"] += severe
+
+        if result.get("latitude") is not None and result.get("longitude") is not None:
+            key = geo_cell(result["latitude"], result["longitude"])
+            cell = self.geo[key]
+            cell["count"] += 1
+            cell["severe"] += severe
+            cell["area_score"] += area_score
+            cell["lat_sum"] += result["latitude"]
+            cell["lon_sum"] += result["longitude"]
+            self._rank_hotspot(key)
+
+        self.last_update = timestamp.isoformat()
+
+    def _rank_hotspot(self, key):
+        # Counts only grow, so the updated cell can only move up in the ranking
+        if key not in self.hotspots:
+            self.hotspots.append(key)
+        self.hotspots.sort(key=lambda k: (self.geo[k]["count"], self.geo[k]["severe"]), reverse=True)
+        del self.hotspots[HOTSPOT_LIMIT:]
+
+    def merge(self, other):
+        """
+        Add the rollups of another aggregator (e.g. the results a serve process
+        collected since its last save) to this one.
+        """
+        self.total += other.total
+        for level, count in other.severity_counts.items():
+            self.severity_counts[level] = self.severity_counts.get(level, 0) + count
+        for cls_name, count in other.class_counts.items():
+            self.class_counts[cls_name] += count
+        for damage_type, count in other.damage_type_counts.items():
+            self.damage_type_counts[damage_type] += count
+        self.no_damage_type += other.no_damage_type
+        self.area_score_sum += other.area_score_sum
+        self.area_score_max = max(self.area_score_max, other.area_score_max)
+        self.processing_time_sum += other.processing_time_sum
+        self.processing_time_count += other.processing_time_count
+        for day, bucket in other.daily.items():
+            for field, value in bucket.items():
+                self.daily[day][field] += value
+        for key, other_cell in other.geo.items():
+            cell = self.geo[key]
+            for field, value in other_cell.items():
+                cell[field] += value
+        # Any cell can overtake the current hotspots after a merge, so rank them all again
+        self.hotspots = sorted(self.geo, key=lambda k: (self.geo[k]["count"], self.geo[k]["severe"]),
+                               reverse=True)[:HOTSPOT_LIMIT]
+        if other.last_update is not None:
+            self.last_update = max(filter(None, (self.last_update, other.last_update)))
+
+    # ======= Dashboard queries =======
+
+    def severity_breakdown(self):
+        """Same shape as /api/severity-breakdown (high and severe are grouped as High)."""
+        return [
+            {"name": "High", "value": self.severity_counts["high"] + self.severity_counts["severe"], "color": "#ef4444"},
+            {"name": "Moderate", "value": self.severity_counts["moderate"], "color": "#f59e0b"},
+            {"name": "Low", "value": self.severity_counts["low"], "color": "#10b981"}
+        ]
+
+    def damage_distribution(self):
+        """Same shape as /api/damage-distribution (only damage types with values > 0)."""
+        counts = defaultdict(int)
+        for damage_type, count in self.damage_type_counts.items():
+            counts[DAMAGE_TYPE_NAMES.get(damage_type, "Other")] += count
+        counts["Other"] += self.no_damage_type
+        names = list(DAMAGE_TYPE_NAMES.values()) + ["Other"]
+        return [{"name": name, "value": counts[name]} for name in names if counts[name] > 0]
+
+    def dashboard_stats(self, now=None):
+        """
+        Detection-derived part of /api/dashboard-stats.
+
+        Review workflow fields (status, resolution) are not part of the
+        detection results and stay with server.js.
+        """
+        now = now or datetime.now()
+        new_this_week = sum(self.daily.get((now - timedelta(days=i)).date().isoformat(), {"count": 0})["count"]
+                            for i in range(7))
+        high = self.severity_counts["high"] + self.severity_counts["severe"]
+        return {
+            "totalInspections": {"count": self.total, "newThisWeek": new_this_week},
+            "highSeverityIssues": {
+                "count": high,
+                "percentage": round(high / self.total * 100) if self.total else 0
+            },
+            # Average processing time in milliseconds
+            "processingTime": {
+                "average": round(self.processing_time_sum / self.processing_time_count * 1000)
+                if self.processing_time_count else 0
+            },
+            "areaScore": {
+                "average": round(self.area_score_sum / self.total, 2) if self.total else 0,
+                "max": round(self.area_score_max, 2)
+            },
+            "damageTypes": dict(self.damage_type_counts),
+            "detectionClasses": dict(self.class_counts),
+            "severityDistribution": dict(self.severity_counts)
+        }
+
+    def hotspot_list(self, limit=HOTSPOT_LIMIT):
+        """Geo cells with the most inspections, with their centroid and severity counts."""
+        spots = []
+        for key in self.hotspots[:limit]:
+            cell = self.geo[key]
+            spots.append({
+                "cell": key,
+                "latitude": round(cell["lat_sum"] / cell["count"], 6),
+                "longitude": round(cell["lon_sum"] / cell["count"], 6),
+                "count": cell["count"],
+                "severe": cell["severe"],
+                "area_score": round(cell["area_score"], 2)
+            })
+        return spots
+
+    def daily_counts(self, days=30, now=None):
+        """Inspections and high / severe results for each of the last ``days`` days."""
+        now = now or datetime.now()
+        result = []
+        for i in reversed(range(days)):
+            day = (now - timedelta(days=i)).date().isoformat()
+            bucket = self.daily.get(day, {"count": 0, "severe": 0})
+            result.append({"date": day, "count": bucket["count"], "severe": bucket["severe"]})
+        return result
+
+    def query(self, name):
+        """Answer a dashboard query by name (used by the serve protocol and the CLI)."""
+        handlers = {
+            "dashboard-stats": self.dashboard_stats,
+            "damage-distribution": self.damage_distribution,
+            "severity-breakdown": self.severity_breakdown,
+            "hotspots": self.hotspot_list,
+            "daily": self.daily_counts
+        }
+        if name not in handlers:
+            raise ValueError(f"Unknown query {name!r}, expected one of {sorted(handlers)}")
+        return handlers[name]()
+
+    # ======= Snapshots =======
+
+    def to_dict(self):
+        return {
+            "total": self.total,
+            "severity_counts": self.severity_counts,
+            "class_counts": dict(self.class_counts),
+            "damage_type_counts": dict(self.damage_type_counts),
+            "no_damage_type": self.no_damage_type,
+            "area_score_sum": self.area_score_sum,
+            "area_score_max": self.area_score_max,
+            "processing_time_sum": self.processing_time_sum,
+            "processing_time_count": self.processing_time_count,
+            "daily": dict(self.daily),
+            "geo": dict(self.geo),
+            "hotspots": self.hotspots,
+            "last_update": self.last_update
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        aggregator = cls()
+        aggregator.total = data["total"]
+        aggregator.severity_counts.update(data["severity_counts"])
+        aggregator.class_counts.update(data["class_counts"])
+        aggregator.damage_type_counts.update(data["damage_type_counts"])
+        aggregator.no_damage_type = data["no_damage_type"]
+        aggregator.area_score_sum = data["area_score_sum"]
+        aggregator.area_score_max = data["area_score_max"]
+        aggregator.processing_time_sum = data["processing_time_sum"]
+        aggregator.processing_time_count = data["processing_time_count"]
+        aggregator.daily.update(data["daily"])
+        aggregator.geo.update(data["geo"])
+        aggregator.hotspots = data["hotspots"]
+        aggregator.last_update = data["last_update"]
+        return aggregator
+
+    def save(self, path):
+        """Write a snapshot atomically (temporary file + rename)."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.to_dict(), f)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Load a snapshot, or start empty if there is none yet."""
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+@contextmanager
+def snapshot_lock(path):
+    """
+    Hold an exclusive lock on ``<path>.lock`` while a snapshot is read and rewritten.
+
+    server.js runs one detect.py process per upload, so several processes can
+    update the same snapshot at once; the lock makes each load / update / save
+    step atomic.
+    """
+    with open(path + ".lock", "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def update_snapshot(path, result, timestamp=None):
+    """
+    Add one result to the snapshot on disk (load, update, atomic save, under snapshot_lock).
+
+    Used by the one-shot detect.py path. A detect.py --serve process keeps its
+    aggregator in memory and merges its new results in with merge_snapshot.
+    """
+    with snapshot_lock(path):
+        aggregator = StreamingAggregator.load(path)
+        aggregator.update(result, timestamp)
+        aggregator.save(path)
+    return aggregator
+
+def merge_snapshot(path, delta):
+    """
+    Merge an aggregator into the snapshot on disk (load, merge, atomic save, under snapshot_lock).
+
+    Updates written by other processes since the last save are kept.
+
+    Returns:
+        StreamingAggregator: The merged snapshot
+    """
+    with snapshot_lock(path):
+        aggregator = StreamingAggregator.load(path)
+        aggregator.merge(delta)
+        aggregator.save(path)
+    return aggregator
+
+def iter_archive(path):
+    """
+    Yield (result, timestamp) pairs from a stored archive.
+
+    Supported inputs:
+        - a JSON file with one result or a list of results (e.g. outputs/results.json)
+        - a JSON lines file with one result per line (detect.py --serve output)
+        - a raw output directory written with DETECT_RAW_DIR (re-scored with rescore.py)
+    Results without a timestamp use the file modification time.
+    """
+    if os.path.isdir(path):
+        from raw_store import load_raw_archive
+        from rescore import rescore_archive
+        for result in rescore_archive(load_raw_archive(path)):
+            yield result, datetime.fromisoformat(result["timestamp"])
+        return
+
+    file_time = datetime.fromtimestamp(os.path.getmtime(path))
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            results = (json.loads(line) for line in f if line.strip())
+        else:
+            data = json.load(f)
+            results = data if isinstance(data, list) else [data]
+        for result in results:
+            timestamp = datetime.fromisoformat(result["timestamp"]) if result.get("timestamp") else file_time
+            yield result, timestamp
+
+def rebuild(paths):
+    """Build a fresh aggregator from stored archives."""
+    aggregator = StreamingAggregator()
+    for path in paths:
+        for result, timestamp in iter_archive(path):
+            aggregator.update(result, timestamp)
+    return aggregator
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incremental dashboard aggregation of detection results")
+    parser.add_argument("--snapshot", default=os.environ.get("DETECT_AGGREGATE_SNAPSHOT", DEFAULT_SNAPSHOT),
+                        help="Snapshot file to read / write")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild_cmd = sub.add_parser("rebuild", help="Rebuild the snapshot from stored results")
+    rebuild_cmd.add_argument("paths", nargs="+", help="Result JSON / JSONL files or raw output directories")
+    query_cmd = sub.add_parser("query", help="Answer a dashboard query from the snapshot")
+    query_cmd.add_argument("name", help="dashboard-stats, damage-distribution, severity-breakdown, hotspots or daily")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        aggregator = rebuild(args.paths)
+        with snapshot_lock(args.snapshot):
+            aggregator.save(args.snapshot)
+        print(f"Aggregated {aggregator.total} results into {args.snapshot}", file=sys.stderr)
+    else:
+        print(json.dumps(StreamingAggregator.load(args.snapshot).query(args.name)))
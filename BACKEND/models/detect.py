@@ -1,5 +1,3 @@
-# Import YOLO from ultralytics - a state-of-the-art object detection model
-from ultralytics import YOLO 
 # Import PyTorch - the deep learning framework used for neural network operations
 import torch
 # Import neural network modules from PyTorch - provides building blocks for neural networks
@@ -22,57 +20,65 @@ from datetime import datetime
 import timm
 # Import time module - for measuring execution time
 import time
+# Import threading - coordinates serve-mode shadow runs with live requests
+import threading
+# Import inspect - the ViT model definition is part of the build cache key
+import inspect
+# Import OpenCV - reads images exactly like ultralytics does for an image path
+import cv2
+# Import ThreadPoolExecutor - runs the YOLO / ViT stages and image prefetching concurrently
+from concurrent.futures import ThreadPoolExecutor
+# Import the shared post-processing helpers (thresholds, severity, box merging)
+from scoring import YOLO_CONF, YOLO_IOU, YOLO_MAX_DET, get_severity, vit_labels_from_scores
+# Import raw output persistence - lets rescore.py recompute results without inference
+from raw_store import RAW_CONF_FLOOR, RAW_MAX_DET, save_raw_outputs
+# Import the model registry - resolves weight paths and supports hot reload / shadow mode
+from registry import ModelRegistry, ShadowRecorder
+# Import the optimized build helpers - channels-last, TorchScript build cache
+from optimize import optimize_mode, build_module, build_yolo
+# Import the dashboard aggregator - incremental rollups fed by each result
+from aggregator import StreamingAggregator, DEFAULT_SNAPSHOT, merge_snapshot, update_snapshot
+# Import the compact detection container - columnar boxes instead of one dict per box
+from detections import DetectionArray, dumps_result
+
+# Directory where raw model outputs are persisted (disabled when not set)
+# Raw outputs are the pre-threshold ViT scores and all YOLO boxes down to RAW_CONF_FLOOR
+RAW_OUTPUT_DIR = os.environ.get("DETECT_RAW_DIR")
 
 # Enable performance optimizations for CPU operations
-# Set the number of threads for parallel processing to 4 - a good balance for most systems
-torch.set_num_threads(4)
+# Use 4 threads for parallel processing - a good balance for most systems
+INFERENCE_THREADS = 4
 # Enable cuDNN benchmark mode - finds the best algorithm for the hardware
 # This can significantly speed up operations on CUDA-enabled GPUs
 torch.backends.cudnn.benchmark = True
 
-# Start timing the model loading process
-# This helps track performance and identify bottlenecks
-start_time = time.time()
-
-# ======= Load YOLO model =======
-# Define the path to the pre-trained YOLO model weights
-model_path = r'C:\Users\USER\tailwindsample\BACKEND\models\best.pt'
-# Load the YOLO model with the specified weights
-yolo_model = YOLO(model_path)
-# Use half-precision (FP16) if GPU is available, otherwise use full precision (FP32)
-# Half precision significantly speeds up inference on compatible GPUs
-yolo_model.model.half() if torch.cuda.is_available() else yolo_model.model.float()
+# Concurrent stage execution: run YOLO and ViT at the same time within a request
+# PyTorch releases the GIL inside its ops, so the two stages overlap. The
+# INFERENCE_THREADS budget is split between them instead of each stage using all of it
+CONCURRENT_STAGES = os.environ.get("DETECT_CONCURRENT", "0") == "1"
+# Threads of the ViT stage in concurrent mode (YOLO gets the rest of the budget)
+VIT_THREADS = int(os.environ.get("DETECT_VIT_THREADS", "1"))
+YOLO_THREADS = max(1, INFERENCE_THREADS - VIT_THREADS) if CONCURRENT_STAGES else INFERENCE_THREADS
+# OpenMP keeps the thread count per calling thread and a new thread starts from
+# the global default, so each budget is set once on the thread that uses it:
+# here for the main thread, through the pool initializers for worker threads
+torch.set_num_threads(YOLO_THREADS)
+# One worker for the ViT stage and one for prefetching the next image of a stream
+# (prefetching only decodes images, it runs no PyTorch ops)
+stage_pool = ThreadPoolExecutor(max_workers=1, initializer=torch.set_num_threads,
+                                initargs=(VIT_THREADS if CONCURRENT_STAGES else INFERENCE_THREADS,))
+prefetch_pool = ThreadPoolExecutor(max_workers=1)
+
+# How many serve-mode results are aggregated between two snapshot saves
+AGGREGATE_SAVE_EVERY = 20
+# How long a shadow run waits for the live queue to drain before running anyway (seconds)
+SHADOW_IDLE_WAIT = 5.0
 
-# ======= Load ViT (Vision Transformer) model =======
 # Set up the device for computation - use GPU if available, otherwise CPU
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # Print which device is being used for transparency
 print(f"Using device: {device}")
 
-# Create a Vision Transformer model using the timm library
-# 'deit_tiny_patch16_224' is a small, efficient ViT variant that works well for this task
-vit_model = timm.create_model('deit_tiny_patch16_224', pretrained=False)
-# Replace the classification head with a custom head for multi-label classification
-# - Takes the original input features from the ViT
-# - Outputs 4 values (one for each damage type)
-# - Uses Sigmoid activation for multi-label prediction (each output between 0-1)
-vit_model.head = nn.Sequential(
-    nn.Linear(vit_model.head.in_features, 4),
-    nn.Sigmoid()
-)
-# Load the pre-trained weights for our custom ViT model
-# map_location ensures the model loads correctly regardless of training device
-vit_model.load_state_dict(torch.load(r'C:\Users\USER\tailwindsample\BACKEND\models\best_vit_multi_label.pth', map_location=device))
-# Move the model to the appropriate device (GPU/CPU)
-vit_model.to(device)
-# Set the model to evaluation mode - disables dropout and uses running stats for batch norm
-vit_model.eval()
-
-# Use half-precision (FP16) for the ViT model if GPU is available
-# This matches the precision used for the YOLO model
-if torch.cuda.is_available():
-    vit_model = vit_model.half()
-
 # Define the image transformation pipeline for the ViT model
 # These transformations prepare the input image for the ViT model
 vit_transform = transforms.Compose([
@@ -85,100 +91,96 @@ vit_transform = transforms.Compose([
     transforms.Normalize(mean=[0.5]*3, std=[0.5]*3)
 ])
 
-# Print how long it took to load both models
-# This helps identify if model loading is a bottleneck
-print(f"Models loaded in {time.time() - start_time:.2f} seconds")
-
-# Define the labels for the ViT model's multi-label classification
-# These are the four types of road damage the model can detect
-vit_labels = ["pothole", "longitudinal_crack", "lateral_crack", "alligator_crack"]
-
-# Define custom confidence thresholds for each damage type
-# These thresholds were determined through validation testing
-# Lower thresholds (like 0.01) make the model more sensitive to certain damage types
-best_thresholds = {
-    "pothole": 0.01,               # Very sensitive detection for potholes
-    "longitudinal_crack": 0.4,     # Higher threshold to reduce false positives
-    "lateral_crack": 0.4,          # Higher threshold to reduce false positives
-    "alligator_crack": 0.01        # Very sensitive detection for alligator cracks
-}
-
-def get_class_color(cls_name):
+def build_vit_model(weight_path):
     """
-    Assigns a specific color to each damage type for visualization.
+    Create the DeiT model with our multi-label head and load its weights.
     
     Args:
-        cls_name (str): The class name of the detected damage
+        weight_path (str): Path to the ViT state dict
         
     Returns:
-        list: RGB color values [R, G, B] for the damage type
+        nn.Module: ViT model on the selected device, in evaluation mode
     """
-    # Normalize the class name to handle different formats (spaces vs underscores)
-    normalized_name = cls_name.replace("_", " ").lower()
-    
-    # Assign specific colors to each damage type for consistent visualization
-    if "pothole" in normalized_name:
-        return [255, 0, 0]  # Red for potholes - most severe/visible damage
-    elif "longitudinal" in normalized_name:
-        return [0, 0, 255]  # Blue for longitudinal cracks
-    elif "lateral" in normalized_name:
-        return [255, 165, 0]  # Orange for lateral cracks
-    elif "alligator" in normalized_name:
-        return [128, 0, 128]  # Purple for alligator cracks
-    
-    # Default color for any unrecognized damage type
-    return [0, 255, 0]  # Green
-
-def get_severity(bboxes, img_width, img_height):
+    # Create a Vision Transformer model using the timm library
+    # 'deit_tiny_patch16_224' is a small, efficient ViT variant that works well for this task
+    vit_model = timm.create_model('deit_tiny_patch16_224', pretrained=False)
+    # Replace the classification head with a custom head for multi-label classification
+    # - Takes the original input features from the ViT
+    # - Outputs 4 values (one for each damage type)
+    # - Uses Sigmoid activation for multi-label prediction (each output between 0-1)
+    vit_model.head = nn.Sequential(
+        nn.Linear(vit_model.head.in_features, 4),
+        nn.Sigmoid()
+    )
+    # Load the pre-trained weights for our custom ViT model
+    # map_location ensures the model loads correctly regardless of training device
+    vit_model.load_state_dict(torch.load(weight_path, map_location=device))
+    # Move the model to the appropriate device (GPU/CPU)
+    vit_model.to(device)
+    # Set the model to evaluation mode - disables dropout and uses running stats for batch norm
+    vit_model.eval()
+
+    # Use half-precision (FP16) for the ViT model if GPU is available
+    # This matches the precision used for the YOLO model
+    if torch.cuda.is_available():
+        vit_model = vit_model.half()
+    return vit_model
+
+# Definition of the ViT model (timm version + build code) - keys the build cache,
+# so changing the backbone or the head invalidates old builds
+VIT_ARCH = f"timm {timm.__version__}\n" + inspect.getsource(build_vit_model)
+
+def load_models(version, files):
     """
-    Calculate the overall severity of road damage based on multiple factors.
+    Load the YOLO and ViT models of one registry version.
+    
+    Used by the ModelRegistry as its loader, both at start-up and on hot reload.
+    MODEL_OPTIMIZE selects the optimized build (see optimize.py); prebuilt
+    artefacts are loaded from the build cache when available.
     
     Args:
-        bboxes (list): List of bounding box dictionaries with damage information
-        img_width (int): Width of the image in pixels
-        img_height (int): Height of the image in pixels
+        version (str): Registry version name
+        files (dict): Resolved weight paths with "yolo" and "vit" entries
         
     Returns:
-        tuple: (severity_level, count_score, area_score, type_score)
-            - severity_level: String rating ("low", "moderate", "high", "severe")
-            - count_score: Number of damage instances
-            - area_score: Sum of relative areas of all damages
-            - type_score: Number of unique damage types
+        dict: {"yolo": YOLO model, "vit": ViT model}
     """
-    # Count the number of damage instances detected
-    count_score = len(bboxes)
-    # Calculate the total relative area of all damages (as percentage of image)
-    area_score = sum([box['rel_area'] for box in bboxes])
-    # Count the number of unique damage types
-    type_score = len(set([box['class'] for box in bboxes]))
-
-    # Determine severity level based on thresholds for each score
-    # Start with the lowest severity
-    severity = "low"
-    # Upgrade to moderate if any score exceeds its threshold
-    if count_score > 5 or area_score > 15 or type_score > 2:
-        severity = "moderate"
-    # Upgrade to high if count or area scores are higher
-    if count_score > 10 or area_score > 30:
-        severity = "high"
-    # Upgrade to severe if count or area scores are very high
-    if count_score > 15 or area_score > 50:
-        severity = "severe"
-    
-    # Return all scores along with the severity level
-    return severity, count_score, area_score, type_score
+    mode = optimize_mode()
 
-def run_vit_prediction(image):
+    # ======= Load YOLO model =======
+    yolo_model = build_yolo(files["yolo"], mode)
+
+    # ======= Load ViT (Vision Transformer) model =======
+    # Example input used to trace the ViT when building the TorchScript version
+    example = torch.rand(1, 3, 224, 224, device=device)
+    if torch.cuda.is_available():
+        example = example.half()
+    vit_model = build_module("vit", files["vit"], lambda: build_vit_model(files["vit"]), example, mode, device,
+                             arch=VIT_ARCH)
+
+    return {"yolo": yolo_model, "vit": vit_model}
+
+# Start timing the model loading process
+# This helps track performance and identify bottlenecks
+start_time = time.time()
+
+# Load the live model version from the registry (models/registry.json)
+# MODEL_VERSION pins a specific version instead of the manifest's "live" entry
+registry = ModelRegistry(load_models, live_version=os.environ.get("MODEL_VERSION"))
+
+# Print how long it took to load both models
+# This helps identify if model loading is a bottleneck
+print(f"Models loaded in {time.time() - start_time:.2f} seconds")
+
+def vit_input_tensor(image):
     """
-    Run the Vision Transformer model to predict damage types in an image.
-    
-    This function is optimized for speed and accepts an already loaded image.
+    Preprocess an image for the ViT model.
     
     Args:
-        image (PIL.Image): The loaded image to analyze
+        image (PIL.Image): The loaded image
         
     Returns:
-        list: Names of detected damage types
+        torch.Tensor: Batch of one normalized 224x224 image on the selected device
     """
     # Convert image to RGB if it's not already (e.g., grayscale or RGBA)
     if image.mode != "RGB":
@@ -193,134 +195,101 @@ def run_vit_prediction(image):
     # Use half precision if on GPU for faster inference
     if torch.cuda.is_available():
         input_tensor = input_tensor.half()
+    return input_tensor
+
+def run_vit_scores(image, vit_model=None):
+    """
+    Run the Vision Transformer model and return its raw sigmoid scores.
+    
+    Args:
+        image (PIL.Image or torch.Tensor): The loaded image, or its vit_input_tensor
+        vit_model (nn.Module, optional): ViT to use, defaults to the live registry version
+        
+    Returns:
+        list: One score between 0 and 1 per entry of vit_labels
+    """
+    # Fall back to the live model when no explicit model is passed
+    if vit_model is None:
+        vit_model = registry.current().models["vit"]
+
+    # Preprocess unless the caller already did (see load_inputs)
+    input_tensor = image if isinstance(image, torch.Tensor) else vit_input_tensor(image)
 
     # Run inference with optimizations:
-    # - torch.no_grad() disables gradient calculation for inference
+    # - torch.inference_mode() disables gradient tracking and version counting
     # - squeeze() removes the batch dimension from the output
-    with torch.no_grad():
+    with torch.inference_mode():
         output = vit_model(input_tensor).squeeze()
 
-    # Process results:
-    # 1. Create a tensor of thresholds for each label
-    # 2. Compare model outputs to thresholds
-    # 3. Convert to integers (0 or 1) and move to CPU as numpy array
-    thresholds = torch.tensor([best_thresholds[label] for label in vit_labels], device=device)
-    predicted = (output > thresholds).int().cpu().numpy()
-
-    # Create a list of labels that were detected (where prediction is 1)
-    predictions = [label for i, label in enumerate(vit_labels) if predicted[i]]
-    return predictions
+    # Move the scores to CPU as plain floats
+    return output.float().cpu().tolist()
 
-def calculate_iou(box1, box2):
+def run_vit_prediction(image):
     """
-    Calculate Intersection over Union (IoU) between two bounding boxes.
+    Run the Vision Transformer model to predict damage types in an image.
     
-    IoU measures the overlap between two boxes and is used for merging similar detections.
+    This function is optimized for speed and accepts an already loaded image.
     
     Args:
-        box1 (list): First box coordinates [x1, y1, x2, y2]
-        box2 (list): Second box coordinates [x1, y1, x2, y2]
+        image (PIL.Image): The loaded image to analyze
         
     Returns:
-        float: IoU value between 0 (no overlap) and 1 (perfect overlap)
+        list: Names of detected damage types
+    """
+    # Compare each score to the per-label threshold in best_thresholds
+    return vit_labels_from_scores(run_vit_scores(image))
+
+def run_yolo(yolo_model, source, save_raw=False):
     """
-    # Find coordinates of the intersection rectangle
-    # Take the maximum of left edges and minimum of right edges
-    x1 = max(box1[0], box2[0])  # Left edge of intersection
-    y1 = max(box1[1], box2[1])  # Top edge of intersection
-    x2 = min(box1[2], box2[2])  # Right edge of intersection
-    y2 = min(box1[3], box2[3])  # Bottom edge of intersection
-
-    # Calculate area of intersection rectangle
-    # If boxes don't overlap, max(0, x2-x1) ensures we get 0
-    inter_area = max(0, x2 - x1) * max(0, y2 - y1)
-    
-    # Calculate areas of both bounding boxes
-    box1_area = (box1[2] - box1[0]) * (box1[3] - box1[1])
-    box2_area = (box2[2] - box2[0]) * (box2[3] - box2[1])
-    
-    # Calculate union area: sum of both areas minus intersection
-    union_area = box1_area + box2_area - inter_area
-
-    # Avoid division by zero
-    if union_area == 0:
-        return 0
+    Run YOLO detection with optimized parameters.
+    
+    Args:
+        yolo_model (YOLO): Model to run
+        source: Image path or BGR array (as returned by cv2.imread)
+        save_raw (bool): Keep every box down to RAW_CONF_FLOOR for raw output persistence
         
-    # Return IoU: intersection area divided by union area
-    return inter_area / union_area
+    Returns:
+        ultralytics Results for the image
+    """
+    results = yolo_model.predict(
+        source=source,               # Path to the image or preloaded BGR array
+        save=False,                  # Don't save detection results to disk
+        verbose=False,               # Don't print verbose output
+        conf=RAW_CONF_FLOOR if save_raw else YOLO_CONF,  # Confidence threshold (0.5 is balanced)
+        iou=YOLO_IOU,                # NMS IoU threshold (0.45 is standard)
+        max_det=RAW_MAX_DET if save_raw else YOLO_MAX_DET,  # Maximum detections per image
+        half=torch.cuda.is_available(),  # Use half precision if GPU available
+        device=0 if torch.cuda.is_available() else 'cpu',  # Use GPU if available
+        imgsz=640                    # Standard input size for YOLO
+    )
+    return results[0]  # Get the first (and only) result
 
-def merge_boxes(bboxes, iou_threshold=0.5):
+def load_inputs(image_path):
     """
-    Merge overlapping bounding boxes of the same class.
+    Load and preprocess an image for both models.
     
-    This reduces duplicate detections of the same damage instance.
+    The YOLO input is read with cv2.imread, which is what ultralytics does for
+    an image path, so detections are identical to passing the path itself.
     
     Args:
-        bboxes (list): List of bounding box dictionaries
-        iou_threshold (float): Minimum IoU for boxes to be merged (default: 0.5)
+        image_path (str): Path to the image file
         
     Returns:
-        list: Merged bounding boxes
+        dict: "image" (PIL.Image), "size" (width, height), "yolo_input"
+            (BGR array, or the path if OpenCV cannot read it) and "vit_input" (tensor)
     """
-    # Initialize empty list for merged boxes and tracking array
-    merged = []
-    used = [False] * len(bboxes)  # Track which boxes have been processed
-
-    # Iterate through all bounding boxes
-    for i in range(len(bboxes)):
-        # Skip if this box has already been merged
-        if used[i]:
-            continue
-            
-        # Get the current box and mark it as used
-        box_a = bboxes[i]
-        group = [box_a]  # Start a new group with this box
-        used[i] = True
-
-        # Compare with all remaining boxes
-        for j in range(i + 1, len(bboxes)):
-            # Skip if this comparison box has already been merged
-            if used[j]:
-                continue
-                
-            box_b = bboxes[j]
-            
-            # Only merge boxes of the same class (damage type)
-            if box_a["class"] == box_b["class"]:
-                # Calculate overlap between boxes
-                iou = calculate_iou(box_a["bbox"], box_b["bbox"])
-                
-                # If overlap is sufficient, add to the group and mark as used
-                if iou >= iou_threshold:
-                    group.append(box_b)
-                    used[j] = True
-
-        # Create a merged box that encompasses all boxes in the group
-        # Find the minimum and maximum coordinates to create a bounding box around all boxes
-        x1 = min([b["bbox"][0] for b in group])  # Leftmost edge
-        y1 = min([b["bbox"][1] for b in group])  # Topmost edge
-        x2 = max([b["bbox"][2] for b in group])  # Rightmost edge
-        y2 = max([b["bbox"][3] for b in group])  # Bottommost edge
-        
-        # Use the highest confidence from the group
-        conf = max([b["conf"] for b in group])
-        
-        # Keep the class name and color from the first box
-        cls_name = box_a["class"]
-        color = box_a["color"]
-
-        # Add the merged box to the results
-        merged.append({
-            "bbox": [x1, y1, x2, y2],
-            "class": cls_name,
-            "conf": round(conf, 2),  # Round confidence to 2 decimal places
-            "color": color
-        })
-
-    # Return the list of merged boxes
-    return merged
-
-def run_detection(image_path, location=None):
+    # Load the image once and reuse it for both models
+    image = Image.open(image_path)
+    image.load()
+    yolo_input = cv2.imread(image_path)
+    return {
+        "image": image,
+        "size": image.size,
+        "yolo_input": yolo_input if yolo_input is not None else image_path,
+        "vit_input": vit_input_tensor(image)
+    }
+
+def run_detection(image_path, location=None, bundle=None, persist_raw=True, inputs=None):
     """
     Main function to run road damage detection on an image.
     
@@ -332,96 +301,97 @@ def run_detection(image_path, location=None):
     5. Calculates severity
     6. Returns comprehensive results
     
+    With DETECT_CONCURRENT=1, steps 2 and 4 run at the same time (the ViT on
+    stage_pool with DETECT_VIT_THREADS threads, YOLO on the calling thread with
+    the rest of INFERENCE_THREADS).
+    
     Args:
         image_path (str): Path to the image file
         location (dict, optional): Dictionary with latitude and longitude
+        bundle (ModelBundle, optional): Model version to use, defaults to the live registry version
+        persist_raw (bool): Save raw outputs when DETECT_RAW_DIR is set (False for shadow runs)
+        inputs (dict, optional): Result of load_inputs(image_path) if already preprocessed
         
     Returns:
-        dict: Complete detection results with all metadata
+        dict: Complete detection results with all metadata; "detections" is a
+            DetectionArray, encode the result with dumps_result
     """
+    # Take one reference to the models for the whole request
+    # A hot reload swapping the live version does not affect a request in flight
+    if bundle is None:
+        bundle = registry.current()
+    yolo_model = bundle.models["yolo"]
+
     # Start timing the detection process
     detection_start = time.time()
     
-    try:
-        # Load the image once and reuse it for both models
-        image = Image.open(image_path)
-    except Exception as e:
-        # Return error information if image loading fails
-        return {"error": f"Error loading image: {e}"}
+    if inputs is None:
+        try:
+            inputs = load_inputs(image_path)
+        except Exception as e:
+            # Return error information if image loading fails
+            return {"error": f"Error loading image: {e}"}
 
     # Get image dimensions for area calculations
-    img_width, img_height = image.size
+    img_width, img_height = inputs["size"]
     
-    # Run YOLO detection with optimized parameters
-    yolo_start = time.time()
-    results = yolo_model.predict(
-        source=image_path,           # Path to the image
-        save=False,                  # Don't save detection results to disk
-        verbose=False,               # Don't print verbose output
-        conf=0.5,                    # Confidence threshold (0.5 is balanced)
-        iou=0.45,                    # NMS IoU threshold (0.45 is standard)
-        max_det=50,                  # Maximum detections per image
-        half=torch.cuda.is_available(),  # Use half precision if GPU available
-        device=0 if torch.cuda.is_available() else 'cpu',  # Use GPU if available
-        imgsz=640                    # Standard input size for YOLO
-    )
+    # When raw outputs are persisted, keep every box down to RAW_CONF_FLOOR
+    # The live threshold (YOLO_CONF) is applied below, so the results are unchanged
+    save_raw = bool(RAW_OUTPUT_DIR) and persist_raw
+
+    def timed_vit():
+        vit_start = time.time()
+        scores = run_vit_scores(inputs["vit_input"], bundle.models["vit"])
+        print(f"ViT inference completed in {time.time() - vit_start:.2f} seconds")
+        return scores
+
+    if CONCURRENT_STAGES:
+        # Start the ViT in the background and run YOLO meanwhile
+        # PyTorch releases the GIL inside its ops, so both stages make progress
+        vit_future = stage_pool.submit(timed_vit)
+        yolo_start = time.time()
+        result = run_yolo(yolo_model, inputs["yolo_input"], save_raw)
+    else:
+        yolo_start = time.time()
+        result = run_yolo(yolo_model, inputs["yolo_input"], save_raw)
     # Print timing information for YOLO inference
     print(f"YOLO inference completed in {time.time() - yolo_start:.2f} seconds")
 
     # Process YOLO detections efficiently
-    result = results[0]  # Get the first (and only) result
-    bboxes = []          # Initialize empty list for bounding boxes
+    # Get all coordinates, confidences and class IDs at once for efficiency
+    # YOLO returns boxes sorted by confidence (highest first)
+    xyxy = result.boxes.xyxy.tolist()
+    confs = result.boxes.conf.tolist()
+    cls_ids = [int(c) for c in result.boxes.cls.tolist()]
     
-    # Process detected boxes if any were found
-    if len(result.boxes) > 0:
-        # Get all confidence values at once for efficiency
-        confs = [float(box.conf[0].item()) for box in result.boxes]
-        
-        # Filter boxes by confidence threshold (0.01 is very permissive)
-        # This allows low-confidence detections that might still be useful
-        valid_indices = [i for i, conf in enumerate(confs) if conf >= 0.01]
-        
-        # Process each valid detection
-        for i in valid_indices:
-            box = result.boxes[i]
-            
-            # Extract bounding box coordinates [x1, y1, x2, y2]
-            x1, y1, x2, y2 = box.xyxy[0].tolist()
-            
-            # Get class ID and name from the result
-            cls_id = int(box.cls[0].item())
-            cls_name = result.names[cls_id]
-
-            # Calculate area metrics for severity assessment
-            width = x2 - x1   # Box width in pixels
-            height = y2 - y1  # Box height in pixels
-            area = width * height  # Absolute area in pixels
-            
-            # Calculate relative area as percentage of image area
-            # This normalizes for different image sizes
-            rel_area = area / (img_width * img_height) * 100
-
-            # Create a dictionary with all box information
-            bboxes.append({
-                "bbox": [x1, y1, x2, y2],  # Coordinates
-                "class": cls_name,          # Damage type
-                "conf": round(confs[i], 2), # Confidence (rounded)
-                "area": round(area, 1),     # Absolute area (rounded)
-                "rel_area": round(rel_area, 2),  # Relative area (rounded)
-                "color": get_class_color(cls_name)  # Color for visualization
-            })
+    # Keep boxes above the live confidence threshold, up to YOLO_MAX_DET of them
+    valid_indices = [i for i, conf in enumerate(confs) if conf >= YOLO_CONF][:YOLO_MAX_DET]
+    
+    # Build all valid detections at once as columns (coordinates, class, conf, area)
+    detections = DetectionArray.from_yolo(xyxy, confs, cls_ids, result.names, img_width, img_height, valid_indices)
 
     # Calculate overall severity based on all detections
-    severity, count_score, area_score, type_score = get_severity(bboxes, img_width, img_height)
+    severity, count_score, area_score, type_score = get_severity(detections, img_width, img_height)
     
-    # Run ViT prediction for additional damage classification
-    vit_start = time.time()
-    vit_predictions = run_vit_prediction(image)
-    print(f"ViT inference completed in {time.time() - vit_start:.2f} seconds")
+    # Run ViT prediction for additional damage classification (or collect the concurrent run)
+    # The raw scores are kept so they can be persisted for re-scoring
+    vit_scores = vit_future.result() if CONCURRENT_STAGES else timed_vit()
+    vit_predictions = vit_labels_from_scores(vit_scores)
+
+    # Persist raw outputs for rescore.py (never fails the detection itself)
+    if save_raw:
+        try:
+            raw_path = save_raw_outputs(
+                RAW_OUTPUT_DIR, image_path, xyxy, confs, cls_ids, result.names,
+                vit_scores, (img_width, img_height), location
+            )
+            print(f"Raw outputs saved to {raw_path}")
+        except Exception as e:
+            print(f"Raw output save error (non-critical): {e}")
 
     # Prepare comprehensive result JSON with all detection information
     result_json = {
-        "detections": bboxes,  # List of all detected damages with details
+        "detections": detections,  # All detected damages with details (DetectionArray)
         "severity": {          # Overall severity assessment
             "level": severity,       # Textual severity level
             "count_score": count_score,  # Number of damages
@@ -432,6 +402,7 @@ def run_detection(image_path, location=None):
         "image_dimensions": [img_width, img_height],  # Original image size
         "latitude": location.get("latitude") if location else None,  # Location data
         "longitude": location.get("longitude") if location else None,
+        "model_version": bundle.version,  # Registry version that produced the result
         "processing_time": round(time.time() - detection_start, 2)  # Processing time
     }
 
@@ -439,6 +410,54 @@ def run_detection(image_path, location=None):
     print(f"Total detection completed in {time.time() - detection_start:.2f} seconds")
     return result_json
 
+def run_detection_stream(requests):
+    """
+    Run detection over a stream of requests, pipelining the preprocessing.
+    
+    While image N is being analysed, image N+1 is read and preprocessed on a
+    background thread, so loading and decoding never sit on the critical path.
+    
+    Args:
+        requests (iterable): Dictionaries with "image_path" and optional
+            "latitude" / "longitude"; entries with an "error" key are passed through
+        
+    Yields:
+        tuple: (request, result) in input order; result is None for requests
+            without an "image_path" (e.g. serve-mode queries)
+    """
+    request_iter = iter(requests)
+
+    def fetch():
+        # Read the next request and preprocess its image
+        request = next(request_iter, None)
+        if request is None or "error" in request or "image_path" not in request:
+            return request, None
+        image_path = request.get("image_path")
+        if not image_path or not os.path.exists(image_path):
+            return request, {"error": f"Image file {image_path} not found."}
+        try:
+            return request, load_inputs(image_path)
+        except Exception as e:
+            return request, {"error": f"Error loading image: {e}"}
+
+    pending = prefetch_pool.submit(fetch)
+    while True:
+        request, inputs = pending.result()
+        if request is None:
+            break
+        # Start preprocessing the next image before running this one
+        pending = prefetch_pool.submit(fetch)
+
+        if "error" in request:
+            yield request, {"error": request["error"]}
+        elif inputs is None:
+            yield request, None
+        elif "error" in inputs:
+            yield request, inputs
+        else:
+            location = {"latitude": request.get("latitude"), "longitude": request.get("longitude")}
+            yield request, run_detection(request["image_path"], location=location, inputs=inputs)
+
 def save_to_mongodb(data, image_path):
     """
     Save detection results to MongoDB.
@@ -459,6 +478,147 @@ def save_to_mongodb(data, image_path):
         # Log any errors but don't crash the program
         print(f"MongoDB error (non-critical): {e}")
 
+def serve():
+    """
+    Long-running mode: process requests from stdin until it is closed.
+    
+    Each input line is a JSON object {"image_path": ..., "latitude": ..., "longitude": ...}
+    and each output line is the JSON result of run_detection (with "image_path" added).
+    A line {"query": "dashboard-stats"} (or damage-distribution, severity-breakdown,
+    hotspots, daily) is answered from the aggregator instead.
+    Once serving, debug prints go to stderr so stdout only carries results.
+    
+    The next request's image is preprocessed while the current one runs
+    (see run_detection_stream).
+    
+    The registry reloads on SIGHUP or when registry.json / the weight files change,
+    without interrupting requests. When a shadow version is configured, sampled
+    requests are re-run in a background thread after the live result is sent:
+    once no live request is pending (waiting at most SHADOW_IDLE_WAIT seconds),
+    the live and the shadow version run back to back on the same inputs, so both
+    latencies are measured under the same conditions. The comparison is appended
+    to the shadow log, with "live_overlap" set when a live request still ran
+    at the same time.
+    
+    Every result also updates a StreamingAggregator. Its snapshot
+    (DETECT_AGGREGATE_SNAPSHOT) is loaded at start. Every AGGREGATE_SAVE_EVERY
+    results and on exit, the results since the last save are merged into the
+    snapshot on disk (merge_snapshot), so updates from one-shot runs and other
+    serve processes sharing the file are kept, and queries see them from then on.
+    """
+    # Keep stdout for results only
+    protocol_out = sys.stdout
+    sys.stdout = sys.stderr
+
+    registry.install_signal_handler()
+    registry.watch()
+
+    # A single worker runs shadow requests so they never delay live responses
+    # Its shadow and live reruns get the same thread budget as the main thread
+    shadow_pool = ThreadPoolExecutor(max_workers=1, initializer=torch.set_num_threads, initargs=(YOLO_THREADS,))
+    recorder = ShadowRecorder()
+    # Live requests read but not answered yet, and answered so far (for shadow timing)
+    live_state = {"pending": 0, "done": 0}
+    live_changed = threading.Condition()
+    # Shadow bundles already run once (the first call includes one-time set-up such as YOLO fusing)
+    warmed_up = set()
+
+    # Dashboard rollups, resumed from the last snapshot
+    snapshot_path = os.environ.get("DETECT_AGGREGATE_SNAPSHOT", DEFAULT_SNAPSHOT)
+    aggregator = StreamingAggregator.load(snapshot_path)
+    # Results since the last save, merged into the snapshot on disk
+    unsaved = StreamingAggregator()
+
+    def run_shadow(image_path, location, live_bundle, shadow_bundle):
+        try:
+            # Wait until no live request is pending, so the shadow run neither
+            # slows live requests down nor gets slowed down by them
+            with live_changed:
+                idle = live_changed.wait_for(lambda: live_state["pending"] == 0, timeout=SHADOW_IDLE_WAIT)
+                done_before = live_state["done"]
+
+            # Time the live and the shadow version back to back on the same inputs;
+            # the live request itself ran with prefetching and possibly another
+            # shadow job, so its processing_time is not comparable
+            inputs = load_inputs(image_path)
+            if id(shadow_bundle) not in warmed_up:
+                run_detection(image_path, location=location, bundle=shadow_bundle, persist_raw=False, inputs=inputs)
+                warmed_up.add(id(shadow_bundle))
+            live_result = run_detection(image_path, location=location, bundle=live_bundle,
+                                        persist_raw=False, inputs=inputs)
+            shadow_result = run_detection(image_path, location=location, bundle=shadow_bundle,
+                                          persist_raw=False, inputs=inputs)
+
+            with live_changed:
+                overlap = not idle or live_state["pending"] > 0 or live_state["done"] != done_before
+            if "error" not in live_result and "error" not in shadow_result:
+                recorder.record(image_path, live_bundle.version, shadow_bundle.version, live_result, shadow_result,
+                                extra={"timing": "back_to_back", "live_overlap": overlap})
+        except Exception as e:
+            print(f"Shadow evaluation error (non-critical): {e}")
+
+    def is_live(request):
+        # Requests that run detection (not queries or invalid lines)
+        return "error" not in request and "image_path" in request
+
+    def read_requests():
+        # Parse stdin lines lazily; run_detection_stream reads ahead by one request
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict) or ("image_path" not in request and "query" not in request):
+                    raise ValueError("expected an object with an image_path or a query")
+            except Exception as e:
+                request = {"error": f"Invalid request: {e}"}
+            if is_live(request):
+                with live_changed:
+                    live_state["pending"] += 1
+            yield request
+
+    for request, result in run_detection_stream(read_requests()):
+        # Dashboard queries are answered from the rollups in constant time
+        if result is None:
+            try:
+                result = {"query": request["query"], "data": aggregator.query(request["query"])}
+            except Exception as e:
+                result = {"error": f"Invalid query: {e}"}
+            protocol_out.write(json.dumps(result) + "\n")
+            protocol_out.flush()
+            continue
+
+        image_path = request.get("image_path")
+        if "error" not in result:
+            timestamp = datetime.now()
+            aggregator.update(result, timestamp)
+            unsaved.update(result, timestamp)
+            if unsaved.total >= AGGREGATE_SAVE_EVERY:
+                aggregator = merge_snapshot(snapshot_path, unsaved)
+                unsaved = StreamingAggregator()
+        # Sample this request for shadow evaluation (skipped if the live version
+        # was swapped by a reload while the request ran)
+        shadow_bundle = registry.shadow()
+        live_bundle = registry.current()
+        if (shadow_bundle is not None and "error" not in result
+                and live_bundle.version == result["model_version"]):
+            location = {"latitude": request.get("latitude"), "longitude": request.get("longitude")}
+            shadow_pool.submit(run_shadow, image_path, location, live_bundle, shadow_bundle)
+        result["image_path"] = image_path
+
+        protocol_out.write(dumps_result(result) + "\n")
+        protocol_out.flush()
+        if is_live(request):
+            with live_changed:
+                live_state["pending"] -= 1
+                live_state["done"] += 1
+                live_changed.notify_all()
+
+    shadow_pool.shutdown(wait=True)
+    if unsaved.total:
+        merge_snapshot(snapshot_path, unsaved)
+
 # ======= Script Entry Point =======
 if __name__ == "__main__":
     # Start timing the entire script execution
@@ -467,9 +627,14 @@ if __name__ == "__main__":
     # Check if required command-line arguments are provided
     if len(sys.argv) < 2:
         # Print usage instructions as JSON for the calling process
-        print(json.dumps({"error": "Usage: python detect.py <image_path> [latitude] [longitude]"}))
+        print(json.dumps({"error": "Usage: python detect.py <image_path> [latitude] [longitude] | --serve"}))
         sys.exit(1)  # Exit with error code
 
+    # Long-running mode with hot reload and shadow evaluation
+    if sys.argv[1] == "--serve":
+        serve()
+        sys.exit(0)
+
     # Extract command-line arguments
     image_path = sys.argv[1]  # First argument is the image path
     
@@ -494,8 +659,6 @@ if __name__ == "__main__":
     # Save results to MongoDB in a background thread if no errors occurred
     if "error" not in result:
         try:
-            # Import threading here to avoid unnecessary import if not used
-            import threading
             # Start MongoDB save in a separate thread to avoid blocking
             threading.Thread(target=save_to_mongodb, args=(result, image_path)).start()
         except:
@@ -511,4 +674,13 @@ if __name__ == "__main__":
     
     # Return the complete results as JSON
     # This output will be captured by the Node.js server that called this script
-    print(json.dumps(result))
\ No newline at end of file
+    # Flushed right away, before the snapshot update below waits for its lock
+    print(dumps_result(result), flush=True)
+
+    if "error" not in result:
+        # Update the dashboard rollups on disk (shared by all one-shot runs, under a file lock)
+        try:
+            update_snapshot(os.environ.get("DETECT_AGGREGATE_SNAPSHOT", DEFAULT_SNAPSHOT), result)
+        except Exception as e:
+            # Log any errors but don't fail the detection (stdout only carries the result now)
+            print(f"Aggregator error (non-critical): {e}", file=sys.stderr)
\ No newline at end of file
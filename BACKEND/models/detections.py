@@ -0,0 +1,427 @@
+# Compact array-backed container for detection results
+#
+# A result's detections are normally a list of dicts (bbox list, class string,
+# conf, area, rel_area and color list per box). DetectionArray keeps the same
+# information as numpy columns instead:
+#
+#   boxes     (N, 4) float32 (float64 only if the coordinates need it)
+#   cls       (N,)   uint16 index into class_names / class_colors
+#   conf      (N,)   uint8 hundredths (conf is reported rounded to 2 decimals)
+#   area      (N,)   int64 tenths (rounded to 1 decimal), absent for merged boxes
+#   rel_area  (N,)   uint32 hundredths (rounded to 2 decimals), absent for merged boxes
+#
+# The rounded values are stored as exact integers, so to_dicts() and to_json()
+# reproduce the current JSON schema bit for bit. merge_boxes and get_severity in
+# scoring.py accept a DetectionArray directly. run_detection and rescore.py keep
+# their detections as DetectionArray until the output boundary, where
+# dumps_result() writes the JSON straight from the columns.
+#
+# to_bytes() / from_bytes() encode the columns in a compact binary wire format
+# (31 bytes per float32 box plus a small per-image header, against about 150
+# bytes per box as JSON) for bulk archives such as rescore.py --format binary;
+# dumps_results_binary() frames whole results with it.
+
+import json
+import struct
+
+import numpy as np
+
+from scoring import get_class_color
+
+# Wire format: magic, version, header length, JSON header, then the column bytes
+WIRE_MAGIC = b"DETA"
+WIRE_VERSION = 1
+
+def round_fixed(values, decimals):
+    """
+    Round like Python's round(value, decimals) and return the scaled integers.
+
+    np.rint(values * 10**decimals) can land on the wrong side of a .5 tie because
+    the multiplication itself rounds; the few values that close to a tie are
+    rounded with Python's round() instead, so the result always matches it.
+
+    Args:
+        values (array-like): Floats to round
+        decimals (int): Number of decimals
+
+    Returns:
+        np.ndarray: int64 array equal to round(value, decimals) * 10**decimals
+    """
+    values = np.asarray(values, dtype=np.float64)
+    scale = 10 ** decimals
+    scaled = values * scale
+    result = np.rint(scaled).astype(np.int64)
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for i in np.flatnonzero(near_tie):
+        result[i] = int(round(round(float(values[i]), decimals) * scale))
+    return result
+
+def compact_boxes(boxes):
+    """Store boxes as float32 when that is lossless, float64 otherwise."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    boxes32 = boxes.astype(np.float32)
+    return boxes32 if np.array_equal(boxes32, boxes) else boxes
+
+def merge_box_arrays(boxes, confs, classes, image_index, iou_threshold=0.5, max_cells=1 << 21):
+    """
+    Array version of scoring.merge_boxes applied to every image at once.
+
+    Groups are formed the same way as merge_boxes: each unused box, in order,
+    absorbs every later unused box of the same class and image whose IoU with
+    it is at least ``iou_threshold``.
+
+    Boxes are split into (image, class) groups, and groups of the same size are
+    stacked, so each stack needs one IoU matrix computation and one greedy pass
+    over its rows (a loop of ``size`` steps, each covering every group at once).
+
+    Args:
+        boxes (np.ndarray): Box coordinates, shape (N, 4)
+        confs (np.ndarray): Confidence per box
+        classes (np.ndarray): Class index per box
+        image_index (np.ndarray): Owning image per box (non-decreasing)
+        iou_threshold (float): Minimum IoU for boxes to be merged
+        max_cells (int): Maximum number of IoU matrix cells computed at once
+
+    Returns:
+        tuple: (boxes, confs, classes, image_index) of the merged boxes
+    """
+    n = len(boxes)
+    if n == 0:
+        return boxes.reshape(-1, 4), confs, classes, image_index
+
+    # One group per (image, class) pair; boxes never merge across groups
+    group_keys = image_index.astype(np.int64) * (int(classes.max(initial=0)) + 1) + classes
+    order = np.argsort(group_keys, kind="stable")
+    starts = np.flatnonzero(np.r_[True, np.diff(group_keys[order]) != 0])
+    sizes = np.diff(np.r_[starts, n])
+
+    # seed[k] is the box whose group box k joins (the seed itself for seeds)
+    seed = np.empty(n, dtype=np.int64)
+    # Stack groups padded to the next power of two, so there are only a few stacks
+    padded_sizes = 1 << np.ceil(np.log2(sizes)).astype(np.int64)
+    for size in np.unique(padded_sizes).tolist():
+        in_stack = padded_sizes == size
+        offsets = np.arange(size)
+        valid = offsets < sizes[in_stack][:, None]
+        # Members of every group in the stack, one row per group (padding repeats the first member)
+        members = order[starts[in_stack][:, None] + np.where(valid, offsets, 0)]
+        chunk = max(1, max_cells // (size * size))
+        for rows in range(0, len(members), chunk):
+            group, group_valid = members[rows:rows + chunk], valid[rows:rows + chunk]
+            b = boxes[group]
+            x1 = np.maximum(b[:, :, None, 0], b[:, None, :, 0])
+            y1 = np.maximum(b[:, :, None, 1], b[:, None, :, 1])
+            x2 = np.minimum(b[:, :, None, 2], b[:, None, :, 2])
+            y2 = np.minimum(b[:, :, None, 3], b[:, None, :, 3])
+            inter_area = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+            areas = (b[:, :, 2] - b[:, :, 0]) * (b[:, :, 3] - b[:, :, 1])
+            union_area = areas[:, :, None] + areas[:, None, :] - inter_area
+            # Boxes with no union area get an IoU of 0, like calculate_iou
+            with np.errstate(divide="ignore", invalid="ignore"):
+                overlaps = np.where(union_area == 0, 0.0, inter_area / union_area) >= iou_threshold
+            # Only later boxes can join a seed
+            overlaps &= np.triu(np.ones((size, size), dtype=bool), 1)
+
+            # Greedy pass: column i is a seed wherever it is still unused (padding starts used)
+            used = ~group_valid
+            owner = group.copy()
+            for i in range(size):
+                is_seed = ~used[:, i]
+                joined = overlaps[:, i] & ~used & is_seed[:, None]
+                owner[joined] = np.broadcast_to(group[:, i:i + 1], joined.shape)[joined]
+                used |= joined
+            seed[group[group_valid]] = owner[group_valid]
+
+    # Reduce each group to its seed, in box order (the seed order used by merge_boxes)
+    by_seed = np.argsort(seed, kind="stable")
+    seeds, first = np.unique(seed[by_seed], return_index=True)
+    grouped = boxes[by_seed]
+    merged = np.stack([
+        np.minimum.reduceat(grouped[:, 0], first),
+        np.minimum.reduceat(grouped[:, 1], first),
+        np.maximum.reduceat(grouped[:, 2], first),
+        np.maximum.reduceat(grouped[:, 3], first)
+    ], axis=1)
+    return merged, np.maximum.reduceat(confs[by_seed], first), classes[seeds], image_index[seeds]
+
+class DetectionArray:
+    """
+    Columnar detections of one image.
+
+    Args:
+        boxes (np.ndarray): Box coordinates, shape (N, 4)
+        cls (np.ndarray): Index into class_names per box
+        conf (np.ndarray): Confidence in hundredths per box
+        area (np.ndarray or None): Absolute area in tenths of a pixel per box
+        rel_area (np.ndarray or None): Relative area in hundredths of a percent per box
+        class_names (list): Class name table
+        class_colors (list, optional): RGB color per class, defaults to get_class_color
+    """
+
+    __slots__ = ("boxes", "cls", "conf", "area", "rel_area", "class_names", "class_colors")
+
+    def __init__(self, boxes, cls, conf, area, rel_area, class_names, class_colors=None):
+        self.boxes = compact_boxes(boxes)
+        self.cls = np.asarray(cls, dtype=np.uint16)
+        self.conf = np.asarray(conf, dtype=np.uint8)
+        self.area = None if area is None else np.asarray(area, dtype=np.int64)
+        self.rel_area = None if rel_area is None else np.asarray(rel_area, dtype=np.uint32)
+        self.class_names = list(class_names)
+        self.class_colors = class_colors or [get_class_color(name) for name in self.class_names]
+
+    def __len__(self):
+        return len(self.cls)
+
+    @classmethod
+    def from_yolo(cls, xyxy, confs, cls_ids, names, img_width, img_height, indices=None):
+        """
+        Build detections from raw YOLO outputs.
+
+        Per box: conf rounded to 2 decimals, area = width * height in pixels
+        rounded to 1 decimal, rel_area = area as a percentage of the image
+        rounded to 2 decimals, and the color of the class.
+
+        Args:
+            xyxy (list or np.ndarray): Box coordinates, one [x1, y1, x2, y2] per box
+            confs (list or np.ndarray): Raw YOLO confidence per box
+            cls_ids (list or np.ndarray): YOLO class ID per box
+            names (dict or list): YOLO class ID to class name mapping
+            img_width (int): Width of the image in pixels
+            img_height (int): Height of the image in pixels
+            indices (list, optional): Subset of boxes to keep, in order
+
+        Returns:
+            DetectionArray
+        """
+        boxes = np.asarray(xyxy, dtype=np.float64).reshape(-1, 4)
+        confs = np.asarray(confs, dtype=np.float64)
+        cls_ids = np.asarray(cls_ids, dtype=np.int64)
+        if indices is not None:
+            indices = np.asarray(indices, dtype=np.int64)
+            boxes, confs, cls_ids = boxes[indices], confs[indices], cls_ids[indices]
+
+        # Plain float64 arithmetic, in the same order as the per-box Python version of
+        # detect.py, so the rounded values match the earlier results exactly
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        rel_areas = areas / (img_width * img_height) * 100
+
+        class_names = [names[i] for i in range(len(names))]
+        return cls(boxes, cls_ids, round_fixed(confs, 2), round_fixed(areas, 1),
+                   round_fixed(rel_areas, 2), class_names)
+
+    @classmethod
+    def from_dicts(cls, detections):
+        """
+        Convert detections in the current JSON schema.
+
+        Raises:
+            ValueError: If a value cannot be stored losslessly (e.g. conf with more than 2 decimals)
+        """
+        class_names, class_colors, lookup = [], [], {}
+        cls_ids = []
+        for detection in detections:
+            name = detection["class"]
+            if name not in lookup:
+                lookup[name] = len(class_names)
+                class_names.append(name)
+                class_colors.append(list(detection["color"]))
+            elif class_colors[lookup[name]] != list(detection["color"]):
+                raise ValueError(f"Class {name!r} appears with different colors")
+            cls_ids.append(lookup[name])
+
+        has_area = bool(detections) and "area" in detections[0]
+        conf = [d["conf"] for d in detections]
+        area = [d["area"] for d in detections] if has_area else None
+        rel_area = [d["rel_area"] for d in detections] if has_area else None
+
+        array = cls([d["bbox"] for d in detections], cls_ids, round_fixed(conf, 2),
+                    None if area is None else round_fixed(area, 1),
+                    None if rel_area is None else round_fixed(rel_area, 2),
+                    class_names, class_colors)
+        if array.to_dicts() != detections:
+            raise ValueError("Detections cannot be stored losslessly in a DetectionArray")
+        return array
+
+    def to_dicts(self):
+        """Detections in the current JSON schema (list of dicts)."""
+        boxes = self.boxes.tolist()
+        cls_ids = self.cls.tolist()
+        confs = [c / 100 for c in self.conf.tolist()]
+        detections = []
+        if self.area is None:
+            for i, c in enumerate(cls_ids):
+                detections.append({
+                    "bbox": boxes[i],
+                    "class": self.class_names[c],
+                    "conf": confs[i],
+                    "color": list(self.class_colors[c])
+                })
+            return detections
+
+        areas = [a / 10 for a in self.area.tolist()]
+        rel_areas = [r / 100 for r in self.rel_area.tolist()]
+        for i, c in enumerate(cls_ids):
+            detections.append({
+                "bbox": boxes[i],
+                "class": self.class_names[c],
+                "conf": confs[i],
+                "area": areas[i],
+                "rel_area": rel_areas[i],
+                "color": list(self.class_colors[c])
+            })
+        return detections
+
+    def severity_scores(self):
+        """
+        Count, area and type scores, as computed by scoring.get_severity.
+
+        Returns:
+            tuple: (count_score, area_score, type_score)
+        """
+        # Sum the rounded floats left to right, exactly like the dict version
+        area_score = sum(r / 100 for r in self.rel_area.tolist()) if self.rel_area is not None else 0
+        return len(self), area_score, len(np.unique(self.cls))
+
+    def merge(self, iou_threshold=0.5):
+        """
+        Merge overlapping boxes of the same class (see scoring.merge_boxes).
+
+        Like merge_boxes, the merged detections carry no area / rel_area.
+        """
+        boxes, conf, cls_ids, _ = merge_box_arrays(
+            self.boxes.astype(np.float64), self.conf, self.cls.astype(np.int64),
+            np.zeros(len(self), dtype=np.int64), iou_threshold
+        )
+        return DetectionArray(boxes, cls_ids, conf, None, None, self.class_names, self.class_colors)
+
+    def detected_classes(self):
+        """Set of class names present in the detections."""
+        return {self.class_names[c] for c in np.unique(self.cls).tolist()}
+
+    def to_bytes(self, verify=False):
+        """
+        Encode in the compact binary wire format.
+
+        Args:
+            verify (bool): Decode the payload again and check that it gives the same
+                to_dicts() output (raises ValueError otherwise)
+
+        Returns:
+            bytes: Encoded detections
+        """
+        header = json.dumps({
+            "n": len(self),
+            "box_dtype": self.boxes.dtype.str,
+            "class_names": self.class_names,
+            "class_colors": [list(color) for color in self.class_colors],
+            "has_area": self.area is not None
+        }).encode()
+        parts = [
+            WIRE_MAGIC, struct.pack("<BI", WIRE_VERSION, len(header)), header,
+            self.boxes.astype(self.boxes.dtype.newbyteorder("<")).tobytes(),
+            self.cls.astype("<u2").tobytes(),
+            self.conf.tobytes()
+        ]
+        if self.area is not None:
+            parts += [self.area.astype("<i8").tobytes(), self.rel_area.astype("<u4").tobytes()]
+        data = b"".join(parts)
+        if verify and DetectionArray.from_bytes(data).to_dicts() != self.to_dicts():
+            raise ValueError("DetectionArray wire round trip does not reproduce the detections")
+        return data
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Decode the compact binary wire format (see to_bytes)."""
+        if data[:4] != WIRE_MAGIC:
+            raise ValueError("Not a DetectionArray payload")
+        version, header_len = struct.unpack_from("<BI", data, 4)
+        if version != WIRE_VERSION:
+            raise ValueError(f"Unsupported DetectionArray wire version {version}")
+        offset = 9
+        header = json.loads(data[offset:offset + header_len])
+        offset += header_len
+        n = header["n"]
+
+        def column(dtype, count):
+            nonlocal offset
+            values = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += values.nbytes
+            return values
+
+        boxes = column(np.dtype(header["box_dtype"]), n * 4).reshape(n, 4)
+        cls_ids = column("<u2", n)
+        conf = column("u1", n)
+        area = column("<i8", n) if header["has_area"] else None
+        rel_area = column("<u4", n) if header["has_area"] else None
+        return cls(boxes, cls_ids, conf, area, rel_area, header["class_names"], header["class_colors"])
+
+    def to_json(self):
+        """
+        Encode straight from the columns, without building the list of dicts.
+
+        The output is identical to json.dumps(self.to_dicts()).
+        """
+        names = [json.dumps(name) for name in self.class_names]
+        colors = [json.dumps(list(color)) for color in self.class_colors]
+        boxes = self.boxes.tolist()
+        cls_ids = self.cls.tolist()
+        confs = self.conf.tolist()
+        if self.area is None:
+            items = (f'{{"bbox": [{b[0]!r}, {b[1]!r}, {b[2]!r}, {b[3]!r}], "class": {names[c]}, '
+                     f'"conf": {conf / 100!r}, "color": {colors[c]}}}'
+                     for b, c, conf in zip(boxes, cls_ids, confs))
+        else:
+            items = (f'{{"bbox": [{b[0]!r}, {b[1]!r}, {b[2]!r}, {b[3]!r}], "class": {names[c]}, '
+                     f'"conf": {conf / 100!r}, "area": {area / 10!r}, "rel_area": {rel_area / 100!r}, '
+                     f'"color": {colors[c]}}}'
+                     for b, c, conf, area, rel_area in zip(boxes, cls_ids, confs,
+                                                           self.area.tolist(), self.rel_area.tolist()))
+        return "[" + ", ".join(items) + "]"
+
+def dumps_result(result):
+    """
+    json.dumps for a result dictionary whose values may be DetectionArray.
+
+    DetectionArray values are encoded with to_json(), everything else with
+    json.dumps, so the output is identical to json.dumps of the dict version.
+    """
+    return "{" + ", ".join(
+        f"{json.dumps(key)}: {value.to_json() if isinstance(value, DetectionArray) else json.dumps(value)}"
+        for key, value in result.items()
+    ) + "}"
+
+def dumps_results_binary(results, verify=False):
+    """
+    Encode result dictionaries whose "detections" are DetectionArray in the binary wire format.
+
+    Each result is framed as two little-endian uint32 lengths, the JSON of its
+    other fields and the to_bytes() payload of its detections.
+
+    Args:
+        results (list): Result dictionaries
+        verify (bool): Check every detections payload round-trips (see to_bytes)
+
+    Returns:
+        bytes: Encoded results
+    """
+    parts = []
+    for result in results:
+        # The key stays in the JSON (as null) so the field order is preserved
+        meta = json.dumps({key: None if key == "detections" else value for key, value in result.items()}).encode()
+        detections = result["detections"].to_bytes(verify)
+        parts += [struct.pack("<II", len(meta), len(detections)), meta, detections]
+    return b"".join(parts)
+
+def loads_results_binary(data):
+    """Decode dumps_results_binary output back to result dictionaries with DetectionArray detections."""
+    results = []
+    offset = 0
+    while offset < len(data):
+        meta_len, detections_len = struct.unpack_from("<II", data, offset)
+        offset += 8
+        result = json.loads(data[offset:offset + meta_len])
+        offset += meta_len
+        result["detections"] = DetectionArray.from_bytes(data[offset:offset + detections_len])
+        offset += detections_len
+        results.append(result)
+    return results
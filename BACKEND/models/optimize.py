@@ -0,0 +1,322 @@
+# Optimized model builds with a persisted build cache
+#
+# MODEL_OPTIMIZE selects how detect.py and predict.py prepare their models:
+#   off      - plain eager models (default, previous behaviour)
+#   eager    - channels-last memory format for every model with a Conv2d (the CNN,
+#              YOLO and the DeiT, whose patch embedding is a Conv2d); YOLO is
+#              also fused (Conv+BatchNorm) by ultralytics' model.fuse()
+#   script   - "eager" plus TorchScript tracing and freezing; the built artefacts
+#              are saved in build_cache/ keyed by the weight file SHA-256 and the
+#              model definition, so later starts load the prebuilt version directly.
+#              YOLO is exported at the fixed input shapes in YOLO_SCRIPT_SHAPES and
+#              only used for images the eager model would letterbox to exactly that
+#              shape (same boxes, same compute); other images use the eager YOLO
+#   compile  - "eager" plus torch.compile (compiled lazily on the first call);
+#              YOLO stays eager because ultralytics re-wraps its model on predict.
+#              Falls back to eager where torch.compile is unsupported (torch 2.0
+#              on Python 3.11+)
+#
+# Usage:
+#   python models/optimize.py build [--mode script]       # prebuild the live registry version
+#   python models/optimize.py benchmark [--runs 20]       # compare modes on the current device
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+# Supported values of MODEL_OPTIMIZE
+OPTIMIZE_MODES = ["off", "eager", "script", "compile"]
+# Version of the build pipeline itself - bump when a change here alters the built artefacts
+BUILD_VERSION = 2
+# Directory holding the persisted builds
+BUILD_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "build_cache")
+
+def optimize_mode():
+    """Read and validate MODEL_OPTIMIZE (defaults to "off")."""
+    mode = os.environ.get("MODEL_OPTIMIZE", "off").lower()
+    if mode not in OPTIMIZE_MODES:
+        raise ValueError(f"MODEL_OPTIMIZE must be one of {OPTIMIZE_MODES}, got {mode!r}")
+    return mode
+
+def file_sha256(path, chunk_size=1 << 20):
+    """SHA-256 of a file, read in 1 MB chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_path(name, weight_path, device, dtype, extension="pt", arch=""):
+    """
+    Build cache location for one model.
+
+    The key covers everything the built artefact depends on: the weight
+    checksum, the model definition (``arch``, e.g. the source code that builds
+    the model) together with BUILD_VERSION, the device type, the precision and
+    the torch version.
+    """
+    arch_hash = hashlib.sha256(f"{BUILD_VERSION}:{arch}".encode()).hexdigest()[:8]
+    key = (f"{file_sha256(weight_path)[:16]}-{arch_hash}-{device.type}-{str(dtype).replace('torch.', '')}"
+           f"-torch{torch.__version__.split('+')[0]}")
+    return os.path.join(BUILD_CACHE_DIR, f"{name}-{key}.{extension}")
+
+def has_conv(model):
+    """True if the model contains any 2D convolution."""
+    return any(isinstance(m, nn.Conv2d) for m in model.modules())
+
+def optimize_eager(model):
+    """
+    Switch models containing a Conv2d to channels-last.
+
+    This includes the DeiT: its patch embedding is a Conv2d, and channels-last
+    input speeds that layer up (about 9% of the ViT forward on CPU).
+    """
+    model.eval()
+    if has_conv(model):
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+def trace_and_freeze(model, example):
+    """Trace a model with an example input and freeze it for inference."""
+    with torch.inference_mode():
+        traced = torch.jit.trace(model, example)
+    # freeze inlines parameters as constants and folds Conv+BN / Conv+Add patterns
+    return torch.jit.freeze(traced.eval())
+
+def compile_model(model):
+    """torch.compile when available and supported, eager model otherwise."""
+    if not hasattr(torch, "compile"):
+        print("torch.compile is not available, using the eager model", file=sys.stderr)
+        return model
+    try:
+        return torch.compile(model)
+    except RuntimeError as e:
+        # torch 2.0 raises here on Python 3.11+
+        print(f"torch.compile is not supported ({e}), using the eager model", file=sys.stderr)
+        return model
+
+def build_module(name, weight_path, build_fn, example, mode, device, arch=""):
+    """
+    Build a plain nn.Module model (ViT, road CNN) for the given mode.
+
+    In "script" mode the frozen TorchScript module is loaded from the build
+    cache when present, otherwise built from ``build_fn()`` and saved.
+
+    Args:
+        name (str): Model name used in the cache file name
+        weight_path (str): Weight file the model is built from (cache key)
+        build_fn (callable): Returns the eager model, loaded and in eval mode
+        example (torch.Tensor): Example input used for tracing
+        mode (str): One of OPTIMIZE_MODES
+        device (torch.device): Device the model runs on
+        arch (str): Model definition included in the cache key (e.g. its source code)
+
+    Returns:
+        Model ready for inference
+    """
+    if mode == "off":
+        return build_fn()
+
+    if mode == "script":
+        path = cache_path(name, weight_path, device, example.dtype, arch=arch)
+        if os.path.exists(path):
+            return torch.jit.load(path, map_location=device)
+        start = time.time()
+        model = optimize_eager(build_fn())
+        if has_conv(model):
+            example = example.contiguous(memory_format=torch.channels_last)
+        scripted = trace_and_freeze(model, example)
+        os.makedirs(BUILD_CACHE_DIR, exist_ok=True)
+        tmp_path = path + ".tmp"
+        torch.jit.save(scripted, tmp_path)
+        os.replace(tmp_path, path)
+        print(f"Built {name} in {time.time() - start:.2f} seconds -> {path}", file=sys.stderr)
+        return scripted
+
+    model = optimize_eager(build_fn())
+    return compile_model(model) if mode == "compile" else model
+
+def yolo_script_shapes():
+    """
+    Read YOLO_SCRIPT_SHAPES: comma separated HEIGHTxWIDTH input shapes exported in script mode.
+
+    The default covers square, 4:3 landscape / portrait and 16:9 landscape
+    uploads at imgsz 640.
+    """
+    value = os.environ.get("YOLO_SCRIPT_SHAPES", "640x640,480x640,640x480,384x640")
+    return [tuple(int(v) for v in shape.split("x")) for shape in value.split(",") if shape.strip()]
+
+def letterbox_unpad(image_shape, new_shape):
+    """Resized (width, height) of an image letterboxed into new_shape (height, width), as ultralytics does."""
+    height, width = image_shape
+    r = min(new_shape[0] / height, new_shape[1] / width)
+    return int(round(width * r)), int(round(height * r))
+
+def letterbox_shape(image_shape, imgsz=640, stride=32):
+    """
+    Input shape (height, width) the eager YOLO predicts an image at.
+
+    Eager (.pt) models letterbox with auto=True: the image is resized to fit
+    imgsz and padded only up to the next multiple of the stride.
+    """
+    new_width, new_height = letterbox_unpad(image_shape, (imgsz, imgsz))
+    return new_height + (imgsz - new_height) % stride, new_width + (imgsz - new_width) % stride
+
+class ScriptedYOLO:
+    """
+    YOLO for script mode: TorchScript exports at fixed shapes, eager model otherwise.
+
+    ultralytics letterboxes TorchScript models with auto=False, i.e. every
+    image is padded to the full export shape. An export is therefore only used
+    when the eager model would predict the image at exactly that shape with
+    the same resize, so results and compute match "off" mode; any other image
+    (or a path / non-array source) goes to the eager model.
+
+    Args:
+        eager (YOLO): Eager model
+        scripted (dict): TorchScript YOLO models by (height, width) export shape
+    """
+
+    def __init__(self, eager, scripted):
+        self.eager = eager
+        self.scripted = scripted
+        self.model = eager.model
+        self.names = eager.names
+
+    def select(self, source, imgsz=640):
+        """The model and imgsz to use for a source."""
+        if isinstance(source, np.ndarray):
+            image_shape = source.shape[:2]
+            shape = letterbox_shape(image_shape, imgsz)
+            if shape in self.scripted and letterbox_unpad(image_shape, shape) == letterbox_unpad(image_shape, (imgsz, imgsz)):
+                return self.scripted[shape], list(shape)
+        return self.eager, imgsz
+
+    def predict(self, source=None, imgsz=640, **kwargs):
+        model, imgsz = self.select(source, imgsz)
+        return model.predict(source=source, imgsz=imgsz, **kwargs)
+
+def build_yolo(weight_path, mode, imgsz=640):
+    """
+    Build the ultralytics YOLO model for the given mode.
+
+    ultralytics already fuses Conv+BN on its first predict call. In "script"
+    mode the model is exported at every YOLO_SCRIPT_SHAPES shape with
+    ultralytics' own TorchScript exporter (which keeps the class names in the
+    file), cached like the other models, and wrapped in a ScriptedYOLO.
+
+    Args:
+        weight_path (str): YOLO .pt weights
+        mode (str): One of OPTIMIZE_MODES
+        imgsz (int): Inference size the exports are matched against
+
+    Returns:
+        YOLO or ScriptedYOLO: Model ready for predict()
+    """
+    import ultralytics
+    from ultralytics import YOLO
+
+    half = torch.cuda.is_available()
+    device = torch.device("cuda" if half else "cpu")
+
+    yolo_model = YOLO(weight_path)
+    # Use half-precision (FP16) if GPU is available, otherwise use full precision (FP32)
+    yolo_model.model.half() if half else yolo_model.model.float()
+
+    if mode == "script":
+        scripted = {}
+        for shape in yolo_script_shapes():
+            # The architecture comes with the .pt file; the exporter version is part of the key
+            path = cache_path(f"yolo{shape[0]}x{shape[1]}", weight_path, device,
+                              torch.float16 if half else torch.float32, "torchscript",
+                              arch=f"ultralytics {ultralytics.__version__}")
+            if not os.path.exists(path):
+                start = time.time()
+                exported = YOLO(weight_path).export(format="torchscript", imgsz=list(shape), half=half,
+                                                    device=0 if half else "cpu")
+                os.makedirs(BUILD_CACHE_DIR, exist_ok=True)
+                os.replace(exported, path)
+                print(f"Built yolo {shape[0]}x{shape[1]} in {time.time() - start:.2f} seconds -> {path}",
+                      file=sys.stderr)
+            scripted[shape] = YOLO(path, task="detect")
+        return ScriptedYOLO(yolo_model, scripted)
+
+    if mode in ("eager", "compile"):
+        yolo_model.model.fuse(verbose=False)
+        yolo_model.model = optimize_eager(yolo_model.model)
+    return yolo_model
+
+def benchmark(fn, runs, warmup=3):
+    """Average latency of fn() in milliseconds."""
+    with torch.inference_mode():
+        for _ in range(warmup):
+            fn()
+        start = time.perf_counter()
+        for _ in range(runs):
+            fn()
+    return (time.perf_counter() - start) / runs * 1000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and benchmark optimized models")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Prebuild the live registry version into build_cache/")
+    build.add_argument("--mode", choices=["script"], default="script")
+    bench = sub.add_parser("benchmark", help="Compare optimize modes on the current device")
+    bench.add_argument("--modes", nargs="+", choices=OPTIMIZE_MODES, default=["off", "eager", "script"])
+    bench.add_argument("--runs", type=int, default=20, help="Timed runs per model (default: 20)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        # Importing detect / predict loads (and caches) the models
+        os.environ["MODEL_OPTIMIZE"] = args.mode
+        import detect
+        import predict
+        print(f"Build cache ready for version {detect.registry.current().version} in {BUILD_CACHE_DIR}")
+        sys.exit(0)
+
+    from PIL import Image
+    import detect
+    import predict
+
+    bundle = detect.registry.current()
+    image = Image.new("RGB", (640, 640), (128, 128, 128))
+    # YOLO is timed on several upload shapes (BGR arrays, as detect.py passes them);
+    # the letterbox, and so the compute, depends on the aspect ratio
+    rng = np.random.default_rng(0)
+    yolo_images = {f"{w}x{h}": rng.integers(0, 255, (h, w, 3), dtype=np.uint8)
+                   for w, h in ((640, 640), (1280, 960), (960, 1280), (1920, 1080), (1000, 700))}
+    vit_input = detect.vit_transform(image).unsqueeze(0).to(detect.device)
+    cnn_input = predict.transform(image).unsqueeze(0).to(predict.device)
+    if torch.cuda.is_available():
+        vit_input = vit_input.half()
+
+    results = {}
+    for mode in args.modes:
+        vit_model = build_module("vit", bundle.files["vit"], lambda: detect.build_vit_model(bundle.files["vit"]),
+                                 vit_input, mode, detect.device, arch=detect.VIT_ARCH)
+        cnn_model = build_module("cnn", predict.model_path, predict.build_model, cnn_input, mode, predict.device,
+                                 arch=predict.CNN_ARCH)
+        yolo_model = build_yolo(bundle.files["yolo"], mode)
+        yolo_kwargs = dict(save=False, verbose=False, conf=0.5, imgsz=640,
+                           half=torch.cuda.is_available(), device=0 if torch.cuda.is_available() else "cpu")
+        results[mode] = {
+            "vit_ms": benchmark(lambda: vit_model(vit_input), args.runs),
+            "cnn_ms": benchmark(lambda: cnn_model(cnn_input), args.runs)
+        }
+        for name, array in yolo_images.items():
+            results[mode][f"yolo_{name}_ms"] = benchmark(lambda: yolo_model.predict(source=array, **yolo_kwargs),
+                                                         args.runs)
+
+    baseline = results[args.modes[0]]
+    columns = list(baseline)
+    print(f"\n{'mode':<10} " + " ".join(f"{c[:-3]:>16}" for c in columns) + f"   (ms, speed-up vs {args.modes[0]})")
+    for mode, timings in results.items():
+        print(f"{mode:<10} " + " ".join(f"{timings[c]:>9.2f} {baseline[c] / timings[c]:>5.2f}x" for c in columns))
+    print(json.dumps({"device": str(detect.device), "threads": torch.get_num_threads(), "results": results}))
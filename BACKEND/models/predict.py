@@ -10,6 +10,10 @@ from PIL import Image
 import sys
 # Import os module - provides functions for interacting with the operating system and file paths
 import os
+# Import inspect - the CNN source code is part of the build cache key
+import inspect
+# Import the optimized build helpers - channels-last, TorchScript build cache
+from optimize import optimize_mode, build_module
 
 # Define the CNN (Convolutional Neural Network) Model architecture
 # This architecture must exactly match what was used during training
@@ -71,7 +75,8 @@ class CNN(nn.Module):
         
         # Flatten the 3D feature maps (64 channels of 16x16) to 1D vector
         # -1 means batch size is inferred, 64*16*16 is the flattened feature dimension
-        x = x.view(-1, 64 * 16 * 16)
+        # reshape (not view) so channels-last inputs from the optimized build also work
+        x = x.reshape(-1, 64 * 16 * 16)
         
         # First fully connected layer with ReLU activation
         x = nn.ReLU()(self.fc1(x))
@@ -94,19 +99,28 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # This ensures the model is found regardless of where the script is run from
 model_path = os.path.join(os.path.dirname(__file__), "road.pth")
 
-# Create an instance of our CNN model
-model = CNN()
-# Move the model to the appropriate device (GPU or CPU)
-model = model.to(device)
+def build_model():
+    # Create an instance of our CNN model
+    model = CNN()
+    # Move the model to the appropriate device (GPU or CPU)
+    model = model.to(device)
 
-# Load the pre-trained weights from the saved model file
-# map_location ensures the model loads correctly regardless of where it was trained
-model.load_state_dict(torch.load(model_path, map_location=device))
+    # Load the pre-trained weights from the saved model file
+    # map_location ensures the model loads correctly regardless of where it was trained
+    model.load_state_dict(torch.load(model_path, map_location=device))
 
-# Set the model to evaluation mode
-# This disables dropout and uses running statistics for batch normalization
-# Essential for correct inference behavior
-model.eval()
+    # Set the model to evaluation mode
+    # This disables dropout and uses running statistics for batch normalization
+    # Essential for correct inference behavior
+    model.eval()
+    return model
+
+# Build the model - MODEL_OPTIMIZE selects the optimized build (see optimize.py)
+# The example input (one 128x128 RGB image) is only used to trace the TorchScript build
+# CNN_ARCH keys the build cache, so editing the CNN class invalidates old builds
+CNN_ARCH = inspect.getsource(CNN)
+model = build_module("cnn", model_path, build_model, torch.rand(1, 3, 128, 128, device=device),
+                     optimize_mode(), device, arch=CNN_ARCH)
 
 # Define the image transformation pipeline that will be applied to each input image
 # Must exactly match the preprocessing used during training for consistent results
@@ -136,9 +150,9 @@ def predict_image(image_path):
     # 5. Move to the appropriate device (GPU/CPU)
     image = transform(image).unsqueeze(0).to(device)
     
-    # Disable gradient calculation during inference
+    # Disable gradient tracking during inference
     # This reduces memory usage and speeds up computation
-    with torch.no_grad():
+    with torch.inference_mode():
         # Pass the image through the model to get the prediction
         output = model(image)
     
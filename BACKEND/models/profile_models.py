@@ -0,0 +1,294 @@
+# Per-layer profiling of the YOLO, DeiT (ViT) and road CNN models
+#
+# Models are loaded through detect.py (live registry version) and predict.py,
+# exactly as the inference scripts load them. Every module gets forward hooks
+# measuring latency, FLOPs, parameters and output activation memory.
+# Numbers are reported as "self" (the module's own work, excluding children)
+# and "total" (inclusive), so the self columns add up to the whole forward pass.
+#
+# Usage:
+#   python models/profile_models.py [--models yolo vit cnn] [--imgsz 640] [--batch 1]
+#                                   [--runs 10] [--output profile.json] [--compare previous.json]
+
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import torch
+import torch.nn as nn
+
+# Native input sizes of the fixed-size models (their layers depend on it)
+VIT_INPUT_SIZE = 224   # deit_tiny_patch16_224 position embeddings
+CNN_INPUT_SIZE = 128   # predict.py fc1 expects 64 x 16 x 16 features
+
+def load_model(name, version=None):
+    """
+    Load one model the way the inference scripts do.
+
+    Args:
+        name (str): "yolo", "vit" or "cnn"
+        version (str, optional): Registry version for yolo / vit
+
+    Returns:
+        tuple: (nn.Module, torch.device)
+    """
+    # Hooks need the eager modules, not the TorchScript build
+    os.environ["MODEL_OPTIMIZE"] = "off"
+    if name in ("yolo", "vit"):
+        if version:
+            os.environ["MODEL_VERSION"] = version
+        import detect
+        models = detect.registry.current().models
+        if name == "vit":
+            return models["vit"], detect.device
+        # ultralytics fuses Conv + BatchNorm before predicting, so profile the fused graph
+        yolo = models["yolo"].model
+        yolo.fuse(verbose=False)
+        yolo.eval()
+        return yolo, detect.device
+    import predict
+    return predict.model, predict.device
+
+def output_bytes(output):
+    """Total size in bytes of the tensors in a module output."""
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, (list, tuple)):
+        return sum(output_bytes(o) for o in output)
+    if isinstance(output, dict):
+        return sum(output_bytes(o) for o in output.values())
+    return 0
+
+def first_tensor(output):
+    """First tensor found in a module output (None if there is none)."""
+    if isinstance(output, torch.Tensor):
+        return output
+    if isinstance(output, (list, tuple)):
+        for o in output:
+            t = first_tensor(o)
+            if t is not None:
+                return t
+    return None
+
+def self_flops(module, inputs, output):
+    """
+    Estimate the FLOPs a module performs itself (children excluded).
+
+    Multiply-adds count as 2 FLOPs. Element-wise layers count 1 FLOP per output element.
+    """
+    out = first_tensor(output)
+    if out is None:
+        return 0
+    if isinstance(module, nn.Conv2d):
+        kh, kw = module.kernel_size
+        return 2 * out.numel() * (module.in_channels // module.groups) * kh * kw
+    if isinstance(module, nn.Linear):
+        return 2 * out.numel() * module.in_features
+    if isinstance(module, (nn.BatchNorm2d, nn.LayerNorm)):
+        return 2 * out.numel()
+    if isinstance(module, (nn.ReLU, nn.SiLU, nn.GELU, nn.Sigmoid, nn.MaxPool2d, nn.Upsample)):
+        return out.numel()
+    # timm Attention: q @ k^T and attn @ v happen inside the module itself
+    if hasattr(module, "num_heads") and hasattr(module, "qkv"):
+        batch, tokens, channels = inputs[0].shape
+        return 4 * batch * tokens * tokens * channels
+    return 0
+
+class LayerProfiler:
+    """
+    Forward hooks collecting per-module statistics over several runs.
+
+    Args:
+        model (nn.Module): Model to profile
+        sync (bool): Synchronize CUDA around each timing
+    """
+
+    def __init__(self, model, sync=False):
+        self.model = model
+        self.sync = sync
+        self.names = {module: name or "(root)" for name, module in model.named_modules()}
+        self.enabled = False
+        # Modules currently inside their forward, innermost last: [module, start, child time, child FLOPs]
+        self._stack = []
+        self.stats = defaultdict(lambda: {"time": 0.0, "child_time": 0.0, "flops": 0, "total_flops": 0,
+                                          "calls": 0, "activation_bytes": 0})
+        self.handles = []
+        for module in self.names:
+            self.handles.append(module.register_forward_pre_hook(self._pre_hook))
+            self.handles.append(module.register_forward_hook(self._post_hook))
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _pre_hook(self, module, inputs):
+        if self.enabled:
+            self._stack.append([module, self._now(), 0.0, 0])
+
+    def _post_hook(self, module, inputs, output):
+        if not self.enabled:
+            return
+        _, start, child_time, child_flops = self._stack.pop()
+        elapsed = self._now() - start
+        flops = self_flops(module, inputs, output)
+        stats = self.stats[module]
+        stats["time"] += elapsed
+        stats["child_time"] += child_time
+        stats["flops"] += flops
+        stats["total_flops"] += flops + child_flops
+        stats["calls"] += 1
+        stats["activation_bytes"] += output_bytes(output)
+        # Charge this call to the module that is actually running it. Containers
+        # that are iterated instead of called (the nn.Sequential YOLO's
+        # _predict_once loops over) never fire hooks, and a module instance can
+        # be shared by many callers (ultralytics' default SiLU), so the static
+        # module tree cannot be used for this
+        if self._stack:
+            self._stack[-1][2] += elapsed
+            self._stack[-1][3] += flops + child_flops
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+    def report(self, runs):
+        """
+        Per-module rows averaged over ``runs`` forward passes.
+
+        Returns:
+            list: One dict per called module with self / total latency (ms),
+                FLOPs, parameters and activation memory
+        """
+        rows = []
+        for module, stats in self.stats.items():
+            rows.append({
+                "module": self.names[module],
+                "type": type(module).__name__,
+                "calls": stats["calls"] // runs,
+                "self_ms": (stats["time"] - stats["child_time"]) / runs * 1000,
+                "total_ms": stats["time"] / runs * 1000,
+                "self_flops": stats["flops"] // runs,
+                "total_flops": stats["total_flops"] // runs,
+                "self_params": sum(p.numel() for p in module.parameters(recurse=False)),
+                "total_params": sum(p.numel() for p in module.parameters()),
+                "activation_bytes": stats["activation_bytes"] // runs
+            })
+        rows.sort(key=lambda row: row["self_ms"], reverse=True)
+        return rows
+
+def profile_model(name, model, device, input_size, batch, runs, warmup):
+    """Profile one model and return its summary and per-module rows."""
+    dtype = next(model.parameters()).dtype
+    example = torch.rand(batch, 3, input_size, input_size, device=device, dtype=dtype)
+    profiler = LayerProfiler(model, sync=device.type == "cuda")
+
+    with torch.inference_mode():
+        # Warm-up runs are not recorded (allocator, thread pools, cuDNN autotuning)
+        for _ in range(warmup):
+            model(example)
+        profiler.enabled = True
+        start = time.perf_counter()
+        for _ in range(runs):
+            model(example)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / runs * 1000
+    profiler.remove()
+
+    rows = profiler.report(runs)
+    root = next(row for row in rows if row["module"] == "(root)")
+    return {
+        "model": name,
+        "input_shape": list(example.shape),
+        "dtype": str(dtype),
+        "device": str(device),
+        "latency_ms": elapsed,
+        "hooked_latency_ms": root["total_ms"],
+        "flops": root["total_flops"],
+        "params": root["total_params"],
+        "modules": rows
+    }
+
+def format_count(value):
+    """Human readable count (K / M / G)."""
+    for unit, scale in (("G", 1e9), ("M", 1e6), ("K", 1e3)):
+        if abs(value) >= scale:
+            return f"{value / scale:.2f}{unit}"
+    return str(value)
+
+def print_table(summary, top):
+    """Print the ``top`` modules of a model by self latency."""
+    print(f"\n=== {summary['model']} {summary['input_shape']} {summary['dtype']} on {summary['device']} ===")
+    print(f"Latency {summary['latency_ms']:.2f} ms (with hooks {summary['hooked_latency_ms']:.2f} ms), "
+          f"FLOPs {format_count(summary['flops'])}, params {format_count(summary['params'])}")
+    header = f"{'module':<40} {'type':<18} {'calls':>5} {'self ms':>9} {'%':>6} {'self FLOPs':>10} {'params':>9} {'act mem':>9}"
+    print(header)
+    print("-" * len(header))
+    total = sum(row["self_ms"] for row in summary["modules"]) or 1.0
+    for row in summary["modules"][:top]:
+        print(f"{row['module'][:40]:<40} {row['type'][:18]:<18} {row['calls']:>5} {row['self_ms']:>9.3f} "
+              f"{row['self_ms'] / total * 100:>5.1f}% {format_count(row['self_flops']):>10} "
+              f"{format_count(row['self_params']):>9} {format_count(row['activation_bytes']) + 'B':>9}")
+
+def print_comparison(current, previous, top):
+    """Print latency deltas against a previous profile JSON."""
+    previous_by_model = {summary["model"]: summary for summary in previous["models"]}
+    for summary in current["models"]:
+        old = previous_by_model.get(summary["model"])
+        if old is None:
+            continue
+        delta = summary["latency_ms"] - old["latency_ms"]
+        print(f"\n=== {summary['model']} vs {previous['created_at']}: "
+              f"{old['latency_ms']:.2f} -> {summary['latency_ms']:.2f} ms ({delta:+.2f} ms) ===")
+        old_rows = {row["module"]: row for row in old["modules"]}
+        changes = []
+        for row in summary["modules"]:
+            if row["module"] in old_rows:
+                changes.append((row["self_ms"] - old_rows[row["module"]]["self_ms"], row["module"]))
+        changes.sort(key=lambda change: abs(change[0]), reverse=True)
+        for change, module in changes[:top]:
+            print(f"{module[:60]:<60} {change:+9.3f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-layer latency / FLOP profiling of the inference models")
+    parser.add_argument("--models", nargs="+", choices=["yolo", "vit", "cnn"], default=["yolo", "vit", "cnn"],
+                        help="Models to profile (default: all)")
+    parser.add_argument("--version", help="Registry version for yolo / vit (default: live)")
+    parser.add_argument("--imgsz", type=int, default=640,
+                        help="YOLO input size (vit and cnn always use their native 224 / 128)")
+    parser.add_argument("--batch", type=int, default=1, help="Batch size (default: 1)")
+    parser.add_argument("--runs", type=int, default=10, help="Timed runs to average (default: 10)")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed warm-up runs (default: 2)")
+    parser.add_argument("--top", type=int, default=25, help="Rows to print per model (default: 25)")
+    parser.add_argument("--output", default="profile.json", help="JSON artifact path (default: profile.json)")
+    parser.add_argument("--compare", help="Previous JSON artifact to compare against")
+    args = parser.parse_args()
+
+    input_sizes = {"yolo": args.imgsz, "vit": VIT_INPUT_SIZE, "cnn": CNN_INPUT_SIZE}
+
+    summaries = []
+    for name in args.models:
+        model, device = load_model(name, args.version)
+        summary = profile_model(name, model, device, input_sizes[name], args.batch, args.runs, args.warmup)
+        print_table(summary, args.top)
+        summaries.append(summary)
+
+    artifact = {
+        "created_at": datetime.now().isoformat(),
+        "torch_version": torch.__version__,
+        "num_threads": torch.get_num_threads(),
+        "batch": args.batch,
+        "runs": args.runs,
+        "models": summaries
+    }
+    with open(args.output, "w") as f:
+        json.dump(artifact, f, indent=2)
+    print(f"\nProfile written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(artifact, json.load(f), args.top)
@@ -0,0 +1,127 @@
+# Persistence of raw model outputs for offline re-scoring
+# detect.py writes one compressed .npz file per analysed image when DETECT_RAW_DIR is set.
+# rescore.py loads the whole directory back as flat numpy arrays.
+
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from scoring import vit_labels
+
+# Lowest YOLO confidence kept in the raw outputs
+# Anything above this floor can later be promoted by lowering YOLO_CONF in rescore.py
+RAW_CONF_FLOOR = 0.01
+# Maximum number of YOLO boxes kept per image in the raw outputs
+RAW_MAX_DET = 300
+
+def save_raw_outputs(raw_dir, image_path, xyxy, confs, cls_ids, names,
+                     vit_scores, image_dimensions, location=None):
+    """
+    Save the raw YOLO and ViT outputs of one image.
+
+    Args:
+        raw_dir (str): Directory holding the raw archive
+        image_path (str): Path to the analysed image
+        xyxy (list): YOLO box coordinates, one [x1, y1, x2, y2] per box
+        confs (list): YOLO confidence per box
+        cls_ids (list): YOLO class ID per box
+        names (dict): YOLO class ID to class name mapping
+        vit_scores (list): Pre-threshold ViT sigmoid scores (ordered like vit_labels)
+        image_dimensions (tuple): (width, height) of the image
+        location (dict, optional): Dictionary with latitude and longitude
+
+    Returns:
+        str: Path of the written file
+    """
+    os.makedirs(raw_dir, exist_ok=True)
+
+    # Store the class names table in ID order so the file is self-describing
+    class_names = [names[i] for i in range(len(names))]
+
+    latitude = location.get("latitude") if location else None
+    longitude = location.get("longitude") if location else None
+
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    out_path = os.path.join(raw_dir, f"{stem}-{int(time.time() * 1000)}.npz")
+
+    np.savez_compressed(
+        out_path,
+        boxes=np.asarray(xyxy, dtype=np.float32).reshape(-1, 4),
+        confs=np.asarray(confs, dtype=np.float32),
+        classes=np.asarray(cls_ids, dtype=np.int16),
+        class_names=np.asarray(class_names, dtype=str),
+        vit_scores=np.asarray(vit_scores, dtype=np.float32),
+        vit_labels=np.asarray(vit_labels, dtype=str),
+        image_dimensions=np.asarray(image_dimensions, dtype=np.int32),
+        location=np.asarray([
+            np.nan if latitude is None else latitude,
+            np.nan if longitude is None else longitude
+        ], dtype=np.float64),
+        image_path=np.asarray(image_path),
+        timestamp=np.asarray(datetime.now().isoformat())
+    )
+    return out_path
+
+def load_raw_archive(raw_dir):
+    """
+    Load every raw output file of a directory into flat arrays.
+
+    Boxes of all images are concatenated, with ``image_index`` pointing back to
+    the owning image and ``classes`` remapped into a single ``class_names`` table.
+
+    Args:
+        raw_dir (str): Directory holding the raw archive
+
+    Returns:
+        dict: Flat numpy arrays (boxes, confs, classes, image_index, vit_scores,
+            image_dimensions, location) plus the class_names, image_paths,
+            timestamps and files lists
+    """
+    files = sorted(f for f in os.listdir(raw_dir) if f.endswith(".npz"))
+
+    class_names = []
+    class_lookup = {}
+    boxes, confs, classes, image_index = [], [], [], []
+    vit_scores, dims, locations, image_paths, timestamps = [], [], [], [], []
+
+    for idx, name in enumerate(files):
+        with np.load(os.path.join(raw_dir, name)) as data:
+            # Files written with a different label order cannot be re-scored together
+            if list(data["vit_labels"]) != vit_labels:
+                raise ValueError(f"{name}: ViT labels {list(data['vit_labels'])} do not match {vit_labels}")
+
+            # Remap the per-file class IDs into the shared class names table
+            remap = np.empty(len(data["class_names"]), dtype=np.int16)
+            for i, cls_name in enumerate(data["class_names"]):
+                cls_name = str(cls_name)
+                if cls_name not in class_lookup:
+                    class_lookup[cls_name] = len(class_names)
+                    class_names.append(cls_name)
+                remap[i] = class_lookup[cls_name]
+
+            n = len(data["confs"])
+            boxes.append(data["boxes"])
+            confs.append(data["confs"])
+            classes.append(remap[data["classes"]] if n else data["classes"])
+            image_index.append(np.full(n, idx, dtype=np.int32))
+            vit_scores.append(data["vit_scores"])
+            dims.append(data["image_dimensions"])
+            locations.append(data["location"])
+            image_paths.append(str(data["image_path"]))
+            timestamps.append(str(data["timestamp"]))
+
+    return {
+        "files": files,
+        "class_names": class_names,
+        "boxes": np.concatenate(boxes).astype(np.float64) if boxes else np.zeros((0, 4)),
+        "confs": np.concatenate(confs).astype(np.float64) if confs else np.zeros(0),
+        "classes": np.concatenate(classes).astype(np.int64) if classes else np.zeros(0, dtype=np.int64),
+        "image_index": np.concatenate(image_index) if image_index else np.zeros(0, dtype=np.int32),
+        "vit_scores": np.stack(vit_scores) if vit_scores else np.zeros((0, len(vit_labels))),
+        "image_dimensions": np.stack(dims) if dims else np.zeros((0, 2), dtype=np.int32),
+        "location": np.stack(locations) if locations else np.zeros((0, 2)),
+        "image_paths": image_paths,
+        "timestamps": timestamps
+    }
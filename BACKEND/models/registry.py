@@ -0,0 +1,315 @@
+# Versioned model registry with hot reload and shadow evaluation
+#
+# The manifest (registry.json next to this file, or MODEL_REGISTRY) lists the
+# available model versions, which one is live and which one, if any, runs in
+# shadow mode on a sampled fraction of requests:
+#
+#   {
+#     "live": "v1",
+#     "shadow": {"version": "v2", "sample_rate": 0.1},
+#     "versions": {
+#       "v1": {"yolo": "best.pt", "vit": "best_vit_multi_label.pth"},
+#       "v2": {"yolo": "best1.pt", "vit": "best_vit_multi_label.pth"}
+#     }
+#   }
+#
+# Relative weight paths are resolved against the manifest directory.
+# A running process reloads on SIGHUP or when the manifest / weight files change.
+# New models are fully loaded before being swapped in, so requests in flight
+# keep using the bundle they started with and no request is dropped.
+#
+# Usage:
+#   python models/registry.py list
+#   python models/registry.py promote <version>
+#   python models/registry.py shadow <version> [--rate 0.1]
+#   python models/registry.py shadow off
+
+import argparse
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# Default manifest location - can be overridden with the MODEL_REGISTRY environment variable
+DEFAULT_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "registry.json")
+# Default file for shadow evaluation records (one JSON object per line)
+DEFAULT_SHADOW_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shadow_log.jsonl")
+
+def read_manifest(manifest_path):
+    """Read a registry manifest from disk."""
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def write_manifest(manifest_path, manifest):
+    """
+    Write a registry manifest atomically.
+
+    The manifest is written to a temporary file in the same directory and then
+    renamed over the old one, so a watching process never reads a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def resolve_spec(manifest_path, spec):
+    """Resolve the weight paths of a version spec against the manifest directory."""
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    return {name: os.path.join(base_dir, path) for name, path in spec.items()}
+
+def file_fingerprint(paths):
+    """Cheap change marker for a set of files: (path, size, mtime) per existing file."""
+    fingerprint = []
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+            fingerprint.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            fingerprint.append((path, None, None))
+    return tuple(fingerprint)
+
+class ModelBundle:
+    """
+    A loaded model version.
+
+    Attributes:
+        version (str): Registry version name
+        files (dict): Resolved weight paths by model name
+        models: Whatever the loader returned (detect.py uses a dict of models)
+        fingerprint (tuple): file_fingerprint of the weights when loaded
+        loaded_at (str): ISO timestamp of the load
+    """
+
+    def __init__(self, version, files, models):
+        self.version = version
+        self.files = files
+        self.models = models
+        self.fingerprint = file_fingerprint(files.values())
+        self.loaded_at = datetime.now().isoformat()
+
+class ModelRegistry:
+    """
+    Holds the live (and optional shadow) model bundles of a running process.
+
+    Args:
+        loader (callable): loader(version, files) -> models, called to build a bundle
+        manifest_path (str, optional): Registry manifest, defaults to MODEL_REGISTRY or registry.json
+        live_version (str, optional): Pin the live version instead of using the manifest
+    """
+
+    def __init__(self, loader, manifest_path=None, live_version=None):
+        self.loader = loader
+        self.manifest_path = manifest_path or os.environ.get("MODEL_REGISTRY", DEFAULT_MANIFEST)
+        self.pinned_version = live_version
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._live = None
+        self._shadow = None
+        self._shadow_rate = 0.0
+        self._manifest_mtime = None
+        self._weights_fingerprint = ()  # Weight files seen by the last reload attempt
+        self.reload()
+
+    def current(self):
+        """Return the live bundle; callers keep the reference for the whole request."""
+        return self._live
+
+    def shadow(self):
+        """Return the shadow bundle if this request is sampled for shadow evaluation, else None."""
+        bundle, rate = self._shadow, self._shadow_rate
+        if bundle is None or random.random() >= rate:
+            return None
+        return bundle
+
+    def _load(self, version, manifest):
+        files = resolve_spec(self.manifest_path, manifest["versions"][version])
+        start = time.time()
+        bundle = ModelBundle(version, files, self.loader(version, files))
+        print(f"Registry: loaded version {version} in {time.time() - start:.2f} seconds", file=sys.stderr)
+        return bundle
+
+    def _is_current(self, bundle, version, manifest):
+        if bundle is None or bundle.version != version:
+            return False
+        files = resolve_spec(self.manifest_path, manifest["versions"][version])
+        return bundle.fingerprint == file_fingerprint(files.values())
+
+    def _get_bundle(self, version, manifest):
+        # Reuse an up-to-date loaded bundle (e.g. promoting the shadow version to live)
+        for bundle in (self._live, self._shadow):
+            if self._is_current(bundle, version, manifest):
+                return bundle
+        return self._load(version, manifest)
+
+    def reload(self):
+        """
+        Re-read the manifest and swap in any changed live / shadow bundle.
+
+        New bundles are loaded outside the swap lock; if loading fails the
+        previous bundle stays in place (except on the very first load).
+
+        Returns:
+            bool: True if any bundle was swapped
+        """
+        with self._reload_lock:
+            try:
+                self._manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+                manifest = read_manifest(self.manifest_path)
+                live_version = self.pinned_version or manifest["live"]
+                shadow_cfg = manifest.get("shadow") or {}
+                shadow_version = shadow_cfg.get("version")
+
+                # Record the weights this attempt sees, so a failed load is only
+                # retried after the next change on disk (like the manifest mtime)
+                wanted = [v for v in (live_version, shadow_version) if v in manifest["versions"]]
+                self._weights_fingerprint = file_fingerprint(
+                    path for v in wanted for path in resolve_spec(self.manifest_path, manifest["versions"][v]).values())
+
+                live = self._get_bundle(live_version, manifest)
+                shadow = None
+                if shadow_version and shadow_version != live_version:
+                    shadow = self._get_bundle(shadow_version, manifest)
+            except Exception as e:
+                if self._live is None:
+                    raise
+                print(f"Registry: reload failed, keeping version {self._live.version}: {e}", file=sys.stderr)
+                return False
+
+            # Atomic swap - requests that already hold the old bundle finish with it
+            with self._lock:
+                changed = live is not self._live or shadow is not self._shadow
+                self._live = live
+                self._shadow = shadow
+                self._shadow_rate = float(shadow_cfg.get("sample_rate", 0.0)) if shadow else 0.0
+            return changed
+
+    def reload_async(self):
+        """Reload in a background thread (safe to call from a signal handler)."""
+        threading.Thread(target=self.reload, daemon=True).start()
+
+    def install_signal_handler(self):
+        """Reload on SIGHUP where the platform supports it."""
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_async())
+
+    def _changed_on_disk(self):
+        try:
+            if os.stat(self.manifest_path).st_mtime_ns != self._manifest_mtime:
+                return True
+        except OSError:
+            return False
+        paths = [entry[0] for entry in self._weights_fingerprint]
+        return file_fingerprint(paths) != self._weights_fingerprint
+
+    def watch(self, interval=2.0):
+        """Poll the manifest and weight files and reload when they change."""
+        def poll():
+            while True:
+                time.sleep(interval)
+                if self._changed_on_disk():
+                    self.reload()
+        thread = threading.Thread(target=poll, daemon=True)
+        thread.start()
+        return thread
+
+def detected_classes(detections):
+    """Class names in a result's detections (list of dicts or DetectionArray)."""
+    if hasattr(detections, "detected_classes"):
+        return detections.detected_classes()
+    return {d["class"] for d in detections}
+
+class ShadowRecorder:
+    """
+    Append shadow evaluation records to a JSON lines file.
+
+    Each record compares the live and shadow results of one request: latency,
+    detection count, detected classes, ViT predictions and severity level.
+    """
+
+    def __init__(self, log_path=None):
+        self.log_path = log_path or os.environ.get("MODEL_SHADOW_LOG", DEFAULT_SHADOW_LOG)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def compare(live_result, shadow_result):
+        """Agreement and latency deltas between a live and a shadow result."""
+        live_classes = detected_classes(live_result["detections"])
+        shadow_classes = detected_classes(shadow_result["detections"])
+        union = live_classes | shadow_classes
+        live_vit = set(live_result["vit_predictions"])
+        shadow_vit = set(shadow_result["vit_predictions"])
+        vit_union = live_vit | shadow_vit
+        return {
+            "latency_live": live_result["processing_time"],
+            "latency_shadow": shadow_result["processing_time"],
+            "latency_delta": round(shadow_result["processing_time"] - live_result["processing_time"], 3),
+            "count_delta": len(shadow_result["detections"]) - len(live_result["detections"]),
+            "class_agreement": round(len(live_classes & shadow_classes) / len(union), 3) if union else 1.0,
+            "vit_agreement": round(len(live_vit & shadow_vit) / len(vit_union), 3) if vit_union else 1.0,
+            "severity_match": live_result["severity"]["level"] == shadow_result["severity"]["level"]
+        }
+
+    def record(self, image_path, live_version, shadow_version, live_result, shadow_result, extra=None):
+        """
+        Compare two results and append the record to the log.
+
+        ``extra`` holds additional fields for the record, e.g. how the two
+        runs were timed.
+        """
+        entry = {
+            "timestamp": datetime.now().isoformat(),
+            "image_path": image_path,
+            "live_version": live_version,
+            "shadow_version": shadow_version
+        }
+        entry.update(self.compare(live_result, shadow_result))
+        entry.update(extra or {})
+        with self._lock:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        return entry
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the model registry manifest")
+    parser.add_argument("--manifest", default=os.environ.get("MODEL_REGISTRY", DEFAULT_MANIFEST),
+                        help="Path to the registry manifest")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="Show versions, live and shadow")
+    promote = sub.add_parser("promote", help="Make a version live")
+    promote.add_argument("version")
+    shadow = sub.add_parser("shadow", help="Set the shadow version ('off' to disable)")
+    shadow.add_argument("version")
+    shadow.add_argument("--rate", type=float, default=0.1, help="Fraction of requests to shadow (default: 0.1)")
+    args = parser.parse_args()
+
+    manifest = read_manifest(args.manifest)
+
+    if args.command == "list":
+        print(json.dumps(manifest, indent=2))
+        sys.exit(0)
+
+    if args.command == "promote":
+        if args.version not in manifest["versions"]:
+            print(f"Unknown version: {args.version}")
+            sys.exit(1)
+        manifest["live"] = args.version
+    elif args.version == "off":
+        manifest["shadow"] = None
+    else:
+        if args.version not in manifest["versions"]:
+            print(f"Unknown version: {args.version}")
+            sys.exit(1)
+        manifest["shadow"] = {"version": args.version, "sample_rate": args.rate}
+
+    write_manifest(args.manifest, manifest)
+    print(f"Updated {args.manifest}: live={manifest['live']}, shadow={manifest.get('shadow')}")
@@ -0,0 +1,202 @@
+# Re-score stored raw model outputs without re-running inference
+#
+# detect.py persists the pre-threshold ViT scores and all YOLO boxes down to
+# RAW_CONF_FLOOR when DETECT_RAW_DIR is set. This script recomputes
+# vit_predictions, detections (optionally merged) and severity for the whole
+# archive with vectorized numpy operations, so tweaks to best_thresholds, the
+# severity cut-offs or the merge IoU threshold can be evaluated in seconds.
+#
+# Usage:
+#   python models/rescore.py <raw_dir> [--config overrides.json] [--merge-iou 0.5] [--output rescored.json]
+#                            [--format json|binary]
+
+import argparse
+import copy
+import json
+import sys
+import time
+
+import numpy as np
+
+from scoring import (
+    vit_labels, best_thresholds, YOLO_CONF, YOLO_MAX_DET, SEVERITY_THRESHOLDS,
+    get_class_color
+)
+from raw_store import load_raw_archive
+from detections import DetectionArray, merge_box_arrays, round_fixed, dumps_result, dumps_results_binary
+
+# Order in which severity levels are upgraded (index 0 is the default)
+SEVERITY_LEVELS = ["low", "moderate", "high", "severe"]
+
+def rescore_archive(archive, thresholds=None, severity_thresholds=None,
+                    yolo_conf=YOLO_CONF, max_det=YOLO_MAX_DET, merge_iou=None):
+    """
+    Recompute detections, severity and ViT predictions for a raw archive.
+
+    Args:
+        archive (dict): Flat arrays returned by raw_store.load_raw_archive
+        thresholds (dict, optional): Per-label ViT thresholds, defaults to best_thresholds
+        severity_thresholds (dict, optional): Cut-offs, defaults to SEVERITY_THRESHOLDS
+        yolo_conf (float): Minimum YOLO confidence for a box to be kept
+        max_det (int): Maximum number of boxes kept per image
+        merge_iou (float, optional): IoU threshold for merge_boxes (no merging when None)
+
+    Returns:
+        list: One result dictionary per image, in the run_detection schema except
+            that "detections" is a DetectionArray (see detections.dumps_result)
+    """
+    thresholds = thresholds or best_thresholds
+    severity_thresholds = severity_thresholds or SEVERITY_THRESHOLDS
+    n_images = len(archive["files"])
+    class_names = archive["class_names"]
+
+    # ======= ViT predictions =======
+    # Compare every stored score against its label threshold in one operation
+    label_thresholds = np.array([thresholds[label] for label in vit_labels])
+    vit_hits = archive["vit_scores"] > label_thresholds
+
+    # ======= YOLO boxes =======
+    # Keep boxes above the confidence threshold
+    keep = archive["confs"] >= yolo_conf
+    boxes = archive["boxes"][keep]
+    confs = archive["confs"][keep]
+    classes = archive["classes"][keep]
+    image_index = archive["image_index"][keep]
+
+    # Keep the first max_det boxes of each image (raw boxes are stored by descending confidence)
+    rank = np.arange(len(image_index)) - np.searchsorted(image_index, image_index, side="left")
+    keep = rank < max_det
+    boxes, confs, classes, image_index = boxes[keep], confs[keep], classes[keep], image_index[keep]
+
+    # Confidences are reported rounded to 2 decimal places (kept as exact hundredths)
+    conf_hundredths = round_fixed(confs, 2)
+
+    if merge_iou is not None and len(boxes):
+        boxes, conf_hundredths, classes, image_index = merge_box_arrays(
+            boxes, conf_hundredths, classes, image_index, merge_iou)
+
+    # ======= Area metrics =======
+    dims = archive["image_dimensions"].astype(np.float64)
+    widths = boxes[:, 2] - boxes[:, 0]
+    heights = boxes[:, 3] - boxes[:, 1]
+    areas = widths * heights
+    rel_hundredths = round_fixed(areas / (dims[image_index, 0] * dims[image_index, 1]) * 100, 2)
+    area_tenths = round_fixed(areas, 1)
+    rel_areas = rel_hundredths / 100
+
+    # ======= Severity =======
+    count_scores = np.bincount(image_index, minlength=n_images)
+    area_scores = np.bincount(image_index, weights=rel_areas, minlength=n_images)
+    # Unique damage types per image: count distinct (image, class) pairs
+    pairs = np.unique(image_index.astype(np.int64) * max(len(class_names), 1) + classes)
+    type_scores = np.bincount(pairs // max(len(class_names), 1), minlength=n_images)
+
+    levels = np.zeros(n_images, dtype=np.int64)
+    for level_idx, level in enumerate(SEVERITY_LEVELS[1:], start=1):
+        cut = severity_thresholds[level]
+        reached = (count_scores > cut["count"]) | (area_scores > cut["area"])
+        if cut.get("types") is not None:
+            reached |= type_scores > cut["types"]
+        levels[reached] = level_idx
+
+    # ======= Build results =======
+    # Each image gets a DetectionArray slice of the flat columns
+    colors = [get_class_color(cls_name) for cls_name in class_names]
+    starts = np.searchsorted(image_index, np.arange(n_images + 1), side="left")
+
+    results = []
+    for idx in range(n_images):
+        span = slice(starts[idx], starts[idx + 1])
+        detections = DetectionArray(boxes[span], classes[span], conf_hundredths[span],
+                                    area_tenths[span], rel_hundredths[span], class_names, colors)
+
+        latitude, longitude = archive["location"][idx].tolist()
+        results.append({
+            "detections": detections,
+            "severity": {
+                "level": SEVERITY_LEVELS[levels[idx]],
+                "count_score": int(count_scores[idx]),
+                "area_score": float(area_scores[idx]),
+                "type_score": int(type_scores[idx])
+            },
+            "vit_predictions": [label for label, hit in zip(vit_labels, vit_hits[idx]) if hit],
+            "image_dimensions": archive["image_dimensions"][idx].tolist(),
+            "latitude": None if np.isnan(latitude) else latitude,
+            "longitude": None if np.isnan(longitude) else longitude,
+            "image_path": archive["image_paths"][idx],
+            "timestamp": archive["timestamps"][idx],
+            "raw_file": archive["files"][idx]
+        })
+    return results
+
+def load_overrides(config_path):
+    """
+    Read scoring overrides from a JSON file.
+
+    Recognised keys: best_thresholds, severity_thresholds, yolo_conf, max_det, merge_iou.
+    Threshold dictionaries are merged on top of the defaults, so only changed
+    values need to be listed.
+
+    Args:
+        config_path (str): Path to the JSON file
+
+    Returns:
+        dict: Keyword arguments for rescore_archive
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+
+    thresholds = dict(best_thresholds)
+    thresholds.update(config.get("best_thresholds", {}))
+
+    severity_thresholds = copy.deepcopy(SEVERITY_THRESHOLDS)
+    for level, cut in config.get("severity_thresholds", {}).items():
+        severity_thresholds[level].update(cut)
+
+    return {
+        "thresholds": thresholds,
+        "severity_thresholds": severity_thresholds,
+        "yolo_conf": config.get("yolo_conf", YOLO_CONF),
+        "max_det": config.get("max_det", YOLO_MAX_DET),
+        "merge_iou": config.get("merge_iou")
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-score stored raw model outputs without re-running inference")
+    parser.add_argument("raw_dir", help="Directory written by detect.py when DETECT_RAW_DIR is set")
+    parser.add_argument("--config", help="JSON file with threshold overrides")
+    parser.add_argument("--merge-iou", type=float, help="Merge same-class boxes with at least this IoU")
+    parser.add_argument("--output", help="Write results to this file instead of stdout")
+    parser.add_argument("--format", choices=["json", "binary"], default="json",
+                        help="json (default) or the compact binary wire format (requires --output, "
+                             "read back with detections.loads_results_binary)")
+    args = parser.parse_args()
+    if args.format == "binary" and not args.output:
+        parser.error("--format binary requires --output")
+
+    options = load_overrides(args.config) if args.config else {}
+    if args.merge_iou is not None:
+        options["merge_iou"] = args.merge_iou
+
+    start_time = time.time()
+    archive = load_raw_archive(args.raw_dir)
+    load_time = time.time() - start_time
+    results = rescore_archive(archive, **options)
+
+    # Timing goes to stderr so stdout stays valid JSON
+    print(f"Loaded {len(results)} raw outputs in {load_time:.2f} seconds, "
+          f"re-scored in {time.time() - start_time - load_time:.2f} seconds", file=sys.stderr)
+
+    if args.format == "binary":
+        # Every payload is decoded again and checked against the dict version before writing
+        with open(args.output, "wb") as f:
+            f.write(dumps_results_binary(results, verify=True))
+        sys.exit(0)
+
+    # Encode the detections straight from their columns
+    output = "[" + ", ".join(dumps_result(result) for result in results) + "]"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
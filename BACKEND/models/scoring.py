@@ -0,0 +1,244 @@
+# Scoring helpers shared by detect.py and rescore.py
+# Everything in this module is pure Python (no torch / ultralytics imports), so
+# post-processing can be re-run over stored raw outputs without loading any model.
+
+# Define the labels for the ViT model's multi-label classification
+# These are the four types of road damage the model can detect
+vit_labels = ["pothole", "longitudinal_crack", "lateral_crack", "alligator_crack"]
+
+# Define custom confidence thresholds for each damage type
+# These thresholds were determined through validation testing
+# Lower thresholds (like 0.01) make the model more sensitive to certain damage types
+best_thresholds = {
+    "pothole": 0.01,               # Very sensitive detection for potholes
+    "longitudinal_crack": 0.4,     # Higher threshold to reduce false positives
+    "lateral_crack": 0.4,          # Higher threshold to reduce false positives
+    "alligator_crack": 0.01        # Very sensitive detection for alligator cracks
+}
+
+# Minimum YOLO confidence for a box to be reported in the results
+YOLO_CONF = 0.5
+# Maximum number of YOLO boxes reported per image
+YOLO_MAX_DET = 50
+# NMS IoU threshold used by YOLO
+YOLO_IOU = 0.45
+
+# Cut-offs used by get_severity, checked from lowest to highest level
+# A level is reached when any of its scores is strictly above the cut-off
+# None means that score is not considered for the level
+SEVERITY_THRESHOLDS = {
+    "moderate": {"count": 5, "area": 15, "types": 2},
+    "high": {"count": 10, "area": 30, "types": None},
+    "severe": {"count": 15, "area": 50, "types": None}
+}
+
+def get_class_color(cls_name):
+    """
+    Assigns a specific color to each damage type for visualization.
+
+    Args:
+        cls_name (str): The class name of the detected damage
+
+    Returns:
+        list: RGB color values [R, G, B] for the damage type
+    """
+    # Normalize the class name to handle different formats (spaces vs underscores)
+    normalized_name = cls_name.replace("_", " ").lower()
+
+    # Assign specific colors to each damage type for consistent visualization
+    if "pothole" in normalized_name:
+        return [255, 0, 0]  # Red for potholes - most severe/visible damage
+    elif "longitudinal" in normalized_name:
+        return [0, 0, 255]  # Blue for longitudinal cracks
+    elif "lateral" in normalized_name:
+        return [255, 165, 0]  # Orange for lateral cracks
+    elif "alligator" in normalized_name:
+        return [128, 0, 128]  # Purple for alligator cracks
+
+    # Default color for any unrecognized damage type
+    return [0, 255, 0]  # Green
+
+def severity_level(count_score, area_score, type_score, thresholds=None):
+    """
+    Map the three severity scores to a severity level.
+
+    Args:
+        count_score (int): Number of damage instances
+        area_score (float): Sum of relative areas of all damages
+        type_score (int): Number of unique damage types
+        thresholds (dict, optional): Cut-offs, defaults to SEVERITY_THRESHOLDS
+
+    Returns:
+        str: Severity level ("low", "moderate", "high", "severe")
+    """
+    thresholds = thresholds or SEVERITY_THRESHOLDS
+
+    # Start with the lowest severity and upgrade as cut-offs are exceeded
+    severity = "low"
+    for level in ("moderate", "high", "severe"):
+        cut = thresholds[level]
+        if (count_score > cut["count"] or area_score > cut["area"]
+                or (cut.get("types") is not None and type_score > cut["types"])):
+            severity = level
+    return severity
+
+def get_severity(bboxes, img_width, img_height, thresholds=None):
+    """
+    Calculate the overall severity of road damage based on multiple factors.
+
+    Args:
+        bboxes (list or DetectionArray): Bounding box dictionaries with damage information
+        img_width (int): Width of the image in pixels
+        img_height (int): Height of the image in pixels
+        thresholds (dict, optional): Cut-offs, defaults to SEVERITY_THRESHOLDS
+
+    Returns:
+        tuple: (severity_level, count_score, area_score, type_score)
+            - severity_level: String rating ("low", "moderate", "high", "severe")
+            - count_score: Number of damage instances
+            - area_score: Sum of relative areas of all damages
+            - type_score: Number of unique damage types
+    """
+    if hasattr(bboxes, "severity_scores"):
+        # DetectionArray: the same scores, computed on its columns
+        count_score, area_score, type_score = bboxes.severity_scores()
+    else:
+        # Count the number of damage instances detected
+        count_score = len(bboxes)
+        # Calculate the total relative area of all damages (as percentage of image)
+        area_score = sum([box['rel_area'] for box in bboxes])
+        # Count the number of unique damage types
+        type_score = len(set([box['class'] for box in bboxes]))
+
+    # Determine severity level based on thresholds for each score
+    severity = severity_level(count_score, area_score, type_score, thresholds)
+
+    # Return all scores along with the severity level
+    return severity, count_score, area_score, type_score
+
+def vit_labels_from_scores(scores, thresholds=None):
+    """
+    Turn the ViT sigmoid scores into the list of predicted damage types.
+
+    Args:
+        scores (sequence): One sigmoid score per entry of vit_labels
+        thresholds (dict, optional): Per-label thresholds, defaults to best_thresholds
+
+    Returns:
+        list: Names of detected damage types
+    """
+    thresholds = thresholds or best_thresholds
+    return [label for label, score in zip(vit_labels, scores) if score > thresholds[label]]
+
+def calculate_iou(box1, box2):
+    """
+    Calculate Intersection over Union (IoU) between two bounding boxes.
+
+    IoU measures the overlap between two boxes and is used for merging similar detections.
+
+    Args:
+        box1 (list): First box coordinates [x1, y1, x2, y2]
+        box2 (list): Second box coordinates [x1, y1, x2, y2]
+
+    Returns:
+        float: IoU value between 0 (no overlap) and 1 (perfect overlap)
+    """
+    # Find coordinates of the intersection rectangle
+    # Take the maximum of left edges and minimum of right edges
+    x1 = max(box1[0], box2[0])  # Left edge of intersection
+    y1 = max(box1[1], box2[1])  # Top edge of intersection
+    x2 = min(box1[2], box2[2])  # Right edge of intersection
+    y2 = min(box1[3], box2[3])  # Bottom edge of intersection
+
+    # Calculate area of intersection rectangle
+    # If boxes don't overlap, max(0, x2-x1) ensures we get 0
+    inter_area = max(0, x2 - x1) * max(0, y2 - y1)
+
+    # Calculate areas of both bounding boxes
+    box1_area = (box1[2] - box1[0]) * (box1[3] - box1[1])
+    box2_area = (box2[2] - box2[0]) * (box2[3] - box2[1])
+
+    # Calculate union area: sum of both areas minus intersection
+    union_area = box1_area + box2_area - inter_area
+
+    # Avoid division by zero
+    if union_area == 0:
+        return 0
+
+    # Return IoU: intersection area divided by union area
+    return inter_area / union_area
+
+def merge_boxes(bboxes, iou_threshold=0.5):
+    """
+    Merge overlapping bounding boxes of the same class.
+
+    This reduces duplicate detections of the same damage instance.
+
+    Args:
+        bboxes (list or DetectionArray): Bounding box dictionaries
+        iou_threshold (float): Minimum IoU for boxes to be merged (default: 0.5)
+
+    Returns:
+        list or DetectionArray: Merged bounding boxes (same type as bboxes)
+    """
+    # DetectionArray merges on its columns
+    if hasattr(bboxes, "merge"):
+        return bboxes.merge(iou_threshold)
+
+    # Initialize empty list for merged boxes and tracking array
+    merged = []
+    used = [False] * len(bboxes)  # Track which boxes have been processed
+
+    # Iterate through all bounding boxes
+    for i in range(len(bboxes)):
+        # Skip if this box has already been merged
+        if used[i]:
+            continue
+
+        # Get the current box and mark it as used
+        box_a = bboxes[i]
+        group = [box_a]  # Start a new group with this box
+        used[i] = True
+
+        # Compare with all remaining boxes
+        for j in range(i + 1, len(bboxes)):
+            # Skip if this comparison box has already been merged
+            if used[j]:
+                continue
+
+            box_b = bboxes[j]
+
+            # Only merge boxes of the same class (damage type)
+            if box_a["class"] == box_b["class"]:
+                # Calculate overlap between boxes
+                iou = calculate_iou(box_a["bbox"], box_b["bbox"])
+
+                # If overlap is sufficient, add to the group and mark as used
+                if iou >= iou_threshold:
+                    group.append(box_b)
+                    used[j] = True
+
+        # Create a merged box that encompasses all boxes in the group
+        # Find the minimum and maximum coordinates to create a bounding box around all boxes
+        x1 = min([b["bbox"][0] for b in group])  # Leftmost edge
+        y1 = min([b["bbox"][1] for b in group])  # Topmost edge
+        x2 = max([b["bbox"][2] for b in group])  # Rightmost edge
+        y2 = max([b["bbox"][3] for b in group])  # Bottommost edge
+
+        # Use the highest confidence from the group
+        conf = max([b["conf"] for b in group])
+
+        # Keep the class name and color from the first box
+        cls_name = box_a["class"]
+        color = box_a["color"]
+
+        # Add the merged box to the results
+        merged.append({
+            "bbox": [x1, y1, x2, y2],
+            "class": cls_name,
+            "conf": round(conf, 2),  # Round confidence to 2 decimal places
+            "color": color
+        })
+
+    # Return the list of merged boxes
+    return merged